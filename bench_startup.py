@@ -0,0 +1,89 @@
+#! venv/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 sts=4 ff=unix ft=python expandtab
+
+"""
+    Startup-time benchmark for run once (cron) mode.
+    Reports import cost per module and the cost of each initialization step.
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# modules imported by run_srpusher (eagerly or lazily), in order
+modules = ["json", "pluggy", "requests", "redis", "yaml", "dateutil.parser", "pushover", "rich.logging", "srpusher", "run_srpusher"]
+
+
+def import_time(module: str) -> tuple:
+    """ import a module in a fresh interpreter, returns (self usec, cumulative usec) of `-X importtime` """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if proc.returncode != 0:
+        return (None, None)
+    for line in reversed(proc.stderr.splitlines()):
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if name.strip() == module:
+            return (int(self_us), int(cumulative_us))
+    return (0, 0)  # already imported by the interpreter itself
+
+
+def imported_by_startup() -> set:
+    """ top-level modules that importing run_srpusher actually pulls in """
+    proc = subprocess.run(
+        [sys.executable, "-c", "import sys; import run_srpusher; print(' '.join(sys.modules))"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    return set(proc.stdout.split())
+
+
+def timeit(func, repeat=5) -> float:
+    """ best of `repeat`, msec """
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        delta = (time.perf_counter() - t) * 1000
+        best = delta if best is None or delta < best else best
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', default="settings.yml", help='configration file')
+    args = parser.parse_args()
+
+    eager = imported_by_startup()
+    print("Import cost (fresh interpreter each):")
+    print(f"  {'module':<20} {'self ms':>9} {'cumul ms':>9}  startup")
+    for module in modules:
+        self_us, cumulative_us = import_time(module)
+        if self_us is None:
+            print(f"  {module:<20} {'-':>9} {'-':>9}  (not installed)")
+            continue
+        print(f"  {module:<20} {self_us / 1000:9.2f} {cumulative_us / 1000:9.2f}  {'eager' if module in eager else 'lazy'}")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import pluggy
+    import run_srpusher
+    from srpusher import Config, SRPusher
+
+    def load_config(use_cache: bool) -> None:
+        c = Config()
+        c._filename = args.config
+        c.use_cache = use_cache
+        return c.settings
+
+    print("\nInitialization cost (best of 5):")
+    load_config(True)  # make the cache
+    print(f"  {'config (YAML parse)':<28} {timeit(lambda: load_config(False)):9.2f} ms")
+    print(f"  {'config (cached)':<28} {timeit(lambda: load_config(True)):9.2f} ms")
+    run_srpusher.scan_plugins(rescan=True)
+    print(f"  {'plugins (walk sys.path)':<28} {timeit(lambda: run_srpusher.scan_plugins(rescan=True)):9.2f} ms")
+    print(f"  {'plugins (cached manifest)':<28} {timeit(lambda: run_srpusher.scan_plugins()):9.2f} ms")
+    print(f"  {'SRPusher()':<28} {timeit(lambda: SRPusher(configfilename=args.config, pm=pluggy.PluginManager('srpusher'))):9.2f} ms")
@@ -4,30 +4,144 @@
 
 import os
 import sys
+import copy
+import json
+import queue
+import atexit
 import logging
-import rich.logging
+import logging.handlers
 import importlib
-import pkgutil
 import argparse
 import pluggy
 
-from srpusher import SRPusher
+from srpusher import SRPusher, Config
 srphookspec = pluggy.HookspecMarker("srpusher")
 
+plugins_cache_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".plugins.cache")
 
-def discover_plugins(disable_plugins=False) -> dict:
-    """ import plugins that named as srpusher_plugin_*py """
+
+def plugins_cache_key() -> list:
+    """ the manifest is valid while no directory in sys.path is modified (a package is installed or removed),
+        except the directory of the cache itself, where caches and databases are written on every run:
+        the plugin files in there are keyed on by their own mtimes.
+    """
+    cache_dir = os.path.dirname(plugins_cache_filename)
+    key = []
+    for path in sys.path:
+        if os.path.abspath(path or ".") == cache_dir:
+            key.append([path, sorted([name, os.stat(os.path.join(cache_dir, name)).st_mtime_ns] for name in os.listdir(cache_dir) if name.startswith("srpusher_plugin_"))])
+            continue
+        try:
+            key.append([path, os.stat(path or ".").st_mtime_ns])
+        except OSError:
+            key.append([path, None])
+    return key
+
+
+def scan_plugins(rescan=False) -> list:
+    """ names of srpusher_plugin_* modules, walking sys.path only if the cached manifest is outdated """
+    key = plugins_cache_key()
+    if not rescan:
+        try:
+            with open(plugins_cache_filename, "r") as fp:
+                manifest = json.load(fp)
+            if manifest.get("key") == key:
+                return manifest.get("plugins")
+        except (OSError, ValueError):
+            pass
+    import pkgutil
+    names = sorted(name for _, name, _ in pkgutil.iter_modules() if name.startswith('srpusher_plugin_'))
+    try:
+        with open(plugins_cache_filename, "w") as fp:
+            json.dump({"key": key, "plugins": names}, fp)
+    except OSError:
+        pass
+    return names
+
+
+def discover_plugins(disable_plugins=False, names=None, rescan=False) -> dict:
+    """ import plugins that named as srpusher_plugin_*py
+        names: explicit list of plugin modules (`global: plugins` in settings.yml), no scan at all.
+    """
     if disable_plugins:
         logging.info("Plugins are disabled.")
         return {}
+    if names is None:
+        names = scan_plugins(rescan=rescan)
     _plugins = {
         name: importlib.import_module(name)
-        for _, name, _ in pkgutil.iter_modules() if name.startswith('srpusher_plugin_')
+        for name in names
     }
-    logging.info("Discovered Plugins: " + str(_plugins), stack_info=False)
+    logging.info("Discovered Plugins: %s", _plugins)
     return _plugins
 
 
+class JsonLinesFormatter(logging.Formatter):
+    """ one json object per line: time, level, logger, message (and exc) """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text  # rendered by LazyQueueHandler
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+_exc_formatter = logging.Formatter()
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """ Renders `msg % args` and the exception in the calling thread, as the args may change (or be mutated) right after logging.
+        The line is formatted (time, level, json) by the listener thread. Records under the level are never built (isEnabledFor).
+        keep_exc_info: the exception is passed as it is, for a handler which renders it by itself (rich tracebacks)
+    """
+
+    def __init__(self, queue, keep_exc_info=False) -> None:
+        super().__init__(queue)
+        self.keep_exc_info = keep_exc_info
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info and not self.keep_exc_info:
+            record.exc_text = record.exc_text or _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def queue_handler(handler: logging.Handler) -> logging.Handler:
+    """ handler is called on a background thread, stopped (and drained) at exit """
+    q = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(q, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return LazyQueueHandler(q, keep_exc_info=getattr(handler, "rich_tracebacks", False))
+
+
+def log_handler(log_json=False) -> logging.Handler:
+    """ rich is imported only on a terminal, cron or a pipe gets the plain handler """
+    if log_json:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonLinesFormatter())
+    elif sys.stderr.isatty():
+        import rich.logging
+        handler = rich.logging.RichHandler(rich_tracebacks=True)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+    else:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    return handler
+
+
 def show_plugins(plugins: dict) -> None:
     """ show list of plugins
         plugins: {'module_name': <class 'module'>}
@@ -46,9 +160,6 @@ def show_plugins(plugins: dict) -> None:
 if __name__ == '__main__':
     loglevel = logging.INFO
 
-    stream_handler: rich.logging.RichHandler = rich.logging.RichHandler(rich_tracebacks=True)
-    stream_handler.setFormatter(logging.Formatter('%(message)s'))
-
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--runonce', '-1', action='store_true', help='run once and exit')
     parser.add_argument('--disable_pushover', action='store_true', help='disable pushover')
@@ -56,6 +167,10 @@ if __name__ == '__main__':
     parser.add_argument('--debug', '-v', action='store_true', help='show more logs')
     parser.add_argument('--disable_plugins', action='store_true', help='disable plugin')
     parser.add_argument('--list_plugins', action='store_true', help='list plugins')
+    parser.add_argument('--rescan_plugins', action='store_true', help='ignore the cached plugin manifest')
+    parser.add_argument('--log_json', action='store_true', help='logs as json lines')
+    parser.add_argument('--log_sync', action='store_true', help='write logs in the calling thread, not in the background')
+    parser.add_argument('--engine', choices=['sync', 'async'], default=None, help='engine, default is `global: engine` in settings.yml or sync')
     args = parser.parse_args().__dict__
 
     if args.get('quiet'):
@@ -65,7 +180,10 @@ if __name__ == '__main__':
     if 'DEBUG' in os.environ:
         loglevel = logging.DEBUG
 
+    stream_handler = log_handler(args.get('log_json') or 'SRPUSHER_LOG_JSON' in os.environ)
     stream_handler.setLevel(loglevel)
+    if not args.get('log_sync'):
+        stream_handler = queue_handler(stream_handler)
     logging.basicConfig(level=loglevel, handlers=[stream_handler])
     if loglevel <= logging.INFO:
         print("hit Ctrl-c to exit.")
@@ -73,14 +191,20 @@ if __name__ == '__main__':
     if args.get('disable_plugins'):
         SRPusher.disable_plugins = True
 
-    plugins = discover_plugins(args.get('disable_plugins'))
+    # settings only, SRPusher opens connections and threads
+    config = Config()
+    plugins = discover_plugins(
+        args.get('disable_plugins'),
+        names=config.settings['global'].get('plugins'),
+        rescan=args.get('rescan_plugins') or args.get('list_plugins'),
+    )
     if args.get('list_plugins'):
         show_plugins(plugins)
         sys.exit(0)
 
-    logging.debug("All plugins: " + str(plugins))
-    pm = pluggy.PluginManager("srpusher")
-    srp = SRPusher(pm=pm)
+    logging.debug("All plugins: %s", plugins)
+    srp = SRPusher(pm=pluggy.PluginManager("srpusher"))
+    pm = srp.pm
     pm.add_hookspecs(SRPusher)
     for package_name, module in plugins.items():
         for m in dir(module):
@@ -88,9 +212,9 @@ if __name__ == '__main__':
                 ci = getattr(module, m)(parent=srp)
                 plugin_name = pm.register(ci)
                 logging.debug(pm.get_hookcallers(ci))
-                logging.info(f"Registered plugin: {package_name}.{m}")
+                logging.info("Registered plugin: %s.%s", package_name, m)
     logging.debug(pm.list_name_plugin())
     logging.info("hit Ctrl-c to exit.")
 
-    srp.run(args.get('runonce'))
+    srp.run(args.get('runonce'), engine=args.get('engine'))
     sys.exit(0)
@@ -3,20 +3,32 @@
 # vim: ts=4 sw=4 sts=4 ff=unix ft=python expandtab
 
 import json
-import yaml
 import requests
 import codecs
 import datetime
 import time
 import random
 import redis
-import dateutil.parser
-import pushover
 import hashlib
 import logging
 import pluggy
 import inspect
+import os
+import socket
+import uuid
+import array
+import collections
+import contextlib
 from typing import Tuple
+from srpusher_time import parse_createtime
+from srpusher_presence import PresenceHistory
+from srpusher_api import QueryAPI
+from srpusher_fetch import FetchPolicy
+from srpusher_debounce import Debouncer
+from srpusher_stream import EventStreamPublisher
+from srpusher_stats import RoomAggregates
+from srpusher_cache import LocalCache
+from srpusher_lag import LagTracker
 
 srphookspec = pluggy.HookspecMarker("srpusher")
 
@@ -25,14 +37,199 @@ class Config(object):
     """ Read configration from a file """
     _filename = "settings.yml"
     _settings = None
+    use_cache = True
 
     @property
     def settings(self):
         if self._settings is None:
+            self._settings = self.load_settings_cache()
+        if self._settings is None:
+            import yaml
             with open(self._filename, "r") as fp:
-                self._settings = yaml.safe_load(fp)
+                self._settings = yaml.load(fp, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+            self.save_settings_cache()
         return self._settings
 
+    @property
+    def settings_cache_filename(self) -> str:
+        return self._filename + ".cache"
+
+    def settings_cache_key(self) -> list:
+        """ the cache is valid while the config file is not modified """
+        st = os.stat(self._filename)
+        return [st.st_mtime_ns, st.st_size]
+
+    def load_settings_cache(self) -> dict:
+        """ Load parsed configration from the cache (json), skips importing and parsing YAML """
+        if not self.use_cache:
+            return None
+        try:
+            with open(self.settings_cache_filename, "r") as fp:
+                cache = json.load(fp)
+            if cache.get("key") == self.settings_cache_key():
+                return cache.get("settings")
+        except (OSError, ValueError, AttributeError):
+            pass
+        return None
+
+    def save_settings_cache(self) -> None:
+        """ settings which do not survive json as they are (e.g. dates, non-string keys) are not cached.
+            The cache holds secrets as the config file does: it is created with the file's mode (at most 0600),
+            and renamed into place so another process never reads it half written.
+        """
+        if not self.use_cache:
+            return
+        tmpname = None
+        try:
+            text = json.dumps({"key": self.settings_cache_key(), "settings": self._settings})
+            if json.loads(text)["settings"] != self._settings:
+                return
+            tmpname = f"{self.settings_cache_filename}.{os.getpid()}.tmp"
+            fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, os.stat(self._filename).st_mode & 0o600)
+            with os.fdopen(fd, "w") as fp:
+                fp.write(text)
+            os.replace(tmpname, self.settings_cache_filename)
+        except (OSError, TypeError, ValueError):
+            # read-only directory, or not json, just no cache
+            if tmpname is not None and os.path.exists(tmpname):
+                os.unlink(tmpname)
+
+
+class LeaseLostError(Exception):
+    """ This instance is no longer the leader, its state writes are fenced off """
+
+
+class LeaderLease(object):
+    """ Leader election with a lease in redis.
+        The lease value is `owner|token`. the token is a fencing token which increases on every new leader,
+        so a stale leader never can commit a state write after another instance has taken over.
+    """
+    key_lease = "_sr_leader_lease"
+    key_fence = "_sr_leader_fence"
+    token = None
+
+    # returns the fencing token if the lease is (re)acquired by ARGV[1], or 0
+    _script_acquire = """
+        local cur = redis.call('GET', KEYS[1])
+        if cur then
+            local owner, token = string.match(cur, '^(.*)|(%d+)$')
+            if owner == ARGV[1] then
+                redis.call('PEXPIRE', KEYS[1], ARGV[2])
+                return tonumber(token)
+            end
+            return 0
+        end
+        local token = redis.call('INCR', KEYS[2])
+        redis.call('SET', KEYS[1], ARGV[1] .. '|' .. token, 'PX', ARGV[2])
+        return token
+    """
+    _script_release = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, parent=None, owner: str = None) -> None:
+        self.parent = parent
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.ttl_sec = float((parent.settings.get('ha') or {}).get('lease_ttl_sec', 60))
+        self.acquire_script = parent.redis.register_script(self._script_acquire)
+        self.release_script = parent.redis.register_script(self._script_release)
+
+    @property
+    def value(self) -> str:
+        return f"{self.owner}|{self.token}"
+
+    @property
+    def is_leader(self) -> bool:
+        return self.token is not None
+
+    def acquire(self, ttl_sec: float = None) -> bool:
+        """ Acquire or renew the lease for ttl_sec (default `ha: lease_ttl_sec`), return True while this instance is the leader """
+        ttl_sec = self.ttl_sec if ttl_sec is None else ttl_sec
+        token = int(self.acquire_script(keys=[self.key_lease, self.key_fence], args=[self.owner, int(ttl_sec * 1000)]))
+        if token:
+            if token != self.token:
+                logging.info("(Leader) acquired the lease, fencing token %d", token)
+            self.token = token
+        elif self.token is not None:
+            logging.warning("(Leader) lost the lease, going standby")
+            self.token = None
+        return self.token is not None
+
+    def release(self) -> None:
+        """ Give up the lease so that a standby takes over immediately """
+        if self.token is not None:
+            self.release_script(keys=[self.key_lease], args=[self.value])
+            self.token = None
+
+
+class UserIntern(object):
+    """ Intern userIds (36 chars UUID) into small integers. The table is persistent in redis and never expires. """
+    key_ids = "_sr_intern_ids"  # userid -> id
+    key_userids = "_sr_intern_userids"  # id -> userid
+    key_seq = "_sr_intern_seq"
+
+    _script_intern = """
+        local ids = {}
+        for i, userid in ipairs(ARGV) do
+            local id = redis.call('HGET', KEYS[1], userid)
+            if not id then
+                id = redis.call('INCR', KEYS[3])
+                redis.call('HSET', KEYS[1], userid, id)
+                redis.call('HSET', KEYS[2], id, userid)
+            end
+            ids[i] = tonumber(id)
+        end
+        return ids
+    """
+
+    def __init__(self, parent=None) -> None:
+        self.parent = parent
+        self.ids = {}
+        self.userids = {}
+        self.intern_script = parent.redis.register_script(self._script_intern)
+
+    def intern(self, userids: list) -> list:
+        """ userIds (lowercased) to ids, only unknown userIds go to redis, in one round trip """
+        misses = list({u for u in userids if u not in self.ids})
+        if misses:
+            for userid, id in zip(misses, self.intern_script(keys=[self.key_ids, self.key_userids, self.key_seq], args=misses)):
+                self.ids[userid] = id
+                self.userids[id] = userid
+        return [self.ids[u] for u in userids]
+
+    def lookup(self, userid: str) -> int:
+        """ userId to id without interning, None if unknown """
+        if userid not in self.ids:
+            id = self.parent.redis.hget(self.key_ids, userid)
+            if id is None:
+                return None
+            self.ids[userid] = int(id)
+            self.userids[int(id)] = userid
+        return self.ids[userid]
+
+    def userid(self, id: int) -> str:
+        """ id to userId """
+        if id not in self.userids:
+            userid = self.parent.redis.hget(self.key_userids, id)
+            if userid is None:
+                return None
+            self.userids[id] = userid
+            self.ids[userid] = id
+        return self.userids[id]
+
+    def userids_of(self, ids: list) -> list:
+        """ ids to userIds, unknown ids are read from redis in one round trip """
+        misses = list({id for id in ids if id not in self.userids})
+        if misses:
+            for id, userid in zip(misses, self.parent.redis.hmget(self.key_userids, misses)):
+                if userid is not None:
+                    self.userids[id] = userid
+                    self.ids[userid] = id
+        return [self.userids.get(id) for id in ids]
+
 
 class SRPusher(Config):
     redis = None
@@ -51,16 +248,31 @@ class SRPusher(Config):
     key_func_count = "_sr_function_counter"
     key_func_count_previous = "_sr_function_counter_previous"
     key_func_gauge = "_sr_function_gauge"
+    key_user_digest = "_sr_user_digest"
+    key_members_ids = "_sr_members_ids"  # interned ids of online users, a set of integers (intset)
     _previous_sr_status_epoch = 0
     _previous_sr_status_epoch_private = 0
     _previous_sr_status = None
+    sr_status_stale = True  # False only if sr_status has just fetched a new status
     _disable_plugins = False
-    _all_members = {}
+    _all_members = {}  # interned id -> number of rooms the user is in
+    _online_ids = None  # interned ids of online users at the previous cycle
+    _fenced_ops = None  # ops of fenced writes deferred until the end of the cycle, see fenced_cycle()
+    lease = None
+    presence = None
+    api = None
+    stream = None
+    room_stats = None
+    cache = None
+    lag = None
 
 
     def __init__(self, dry_run=False, configfilename="settings.yml", pm=None) -> None:
         self._filename = configfilename
         self.pm = pm
+        self.current_rooms = {}  # roomid -> room of this cycle
+        self.room_members = {}  # roomid -> array of interned ids of members
+        self.user_digests_new = {}  # userid -> digest changed in this cycle, written after the diff
         if 'debug' in self.settings['global'] and self.settings['global'].get('debug') is True:
             self.debug = True
         if dry_run:
@@ -79,10 +291,31 @@ class SRPusher(Config):
             )
         # if you don't want send something via pushover, just remove `pushover` from settings.yml
         if self.settings['pushover']:
+            import pushover
             self.pushover = pushover.Client(
                 self.settings['pushover']['user_key'],
                 api_token=self.settings['pushover']['api_token'],
             )
+        if (self.settings.get('cache') or {}).get('use') is True:
+            self.cache = LocalCache(parent=self, prefixes=(self.header_usercache, self.header_roomcache))  # started by run()
+        self.intern = UserIntern(parent=self)
+        self.fetch_policy = FetchPolicy(parent=self)
+        self.debounce_users = Debouncer(parent=self, kind="users")
+        self.debounce_rooms = Debouncer(parent=self, kind="rooms")
+        if (self.settings.get('presence') or {}).get('use') is True:
+            self.presence = PresenceHistory(parent=self)
+        if (self.settings.get('api') or {}).get('use') is True:
+            self.api = QueryAPI(parent=self)
+        if (self.settings.get('stats') or {}).get('use') is True:
+            self.room_stats = RoomAggregates(parent=self)
+        if (self.settings.get('lag') or {}).get('use') is True:
+            self.lag = LagTracker(parent=self)
+        if (self.settings.get('stream') or {}).get('use') is True and self.pm is not None:
+            self.stream = EventStreamPublisher(parent=self)
+            self.pm.register(self.stream, name="srpusher_stream")
+        # leader election, for running standby instances
+        if (self.settings.get('ha') or {}).get('use') is True:
+            self.lease = LeaderLease(parent=self)
 
 
     @property
@@ -110,28 +343,55 @@ class SRPusher(Config):
         min_wait_sec = 10
         if (self._previous_sr_status_epoch + min_wait_sec) > time.time():
             self.function_counter(inspect.currentframe().f_code.co_name + ".requests.cache")
+            self.sr_status_stale = True
             return self._previous_sr_status
+        if not self.fetch_policy.allow():
+            self.function_counter(inspect.currentframe().f_code.co_name + ".requests.backoff")
+            self.sr_status_stale = True
+            return self._previous_sr_status
+
+        url, http_headers = self.sr_status_request
+        time_response = time.time()
+        try:
+            response = requests.get(url, headers=http_headers, timeout=self.fetch_policy.timeout)
+        except requests.RequestException as e:
+            return self.receive_sr_status(None, str(e), time.time() - time_response)
+        return self.receive_sr_status(response.status_code, response.text, time.time() - time_response)
 
+    @property
+    def sr_status_request(self) -> Tuple[str, dict]:
+        """ URL and HTTP headers of SR API """
         http_headers = {
             "User-Agent": self.settings["sr"]["http_user_agent"] if "http_user_agent" in self.settings["sr"] else self.default_ua
         }
         url = self.settings["sr"]["api_url"]
         if url.startswith("uggcf://"):
             url = codecs.decode(url, 'rot13')
+        return url, http_headers
 
-        time_response = time.time()
-        response = requests.get(url, headers=http_headers)
-        time_response_delta = time.time() - time_response
-        self.function_gauge(inspect.currentframe().f_code.co_name + ".requests_http_response_time", time_response_delta)
-
-        if response.status_code == requests.codes.ok:
+    def receive_sr_status(self, status_code: int, text: str, time_response_delta: float) -> dict:
+        """ Take a response of SR API, status_code is None if the request has failed.
+            On error, the previous status is kept and marked as stale.
+        """
+        self.function_gauge("sr_status.requests_http_response_time", time_response_delta)
+        content = None
+        if status_code == requests.codes.ok:
+            try:
+                content = json.loads(text)
+            except ValueError:
+                pass
+        if type(content) is dict and type(content.get("rooms")) is list:
             self._previous_sr_status_epoch = time.time()
-            self._previous_sr_status = json.loads(response.text)
-            self.function_counter(inspect.currentframe().f_code.co_name + ".requests.ok")
+            self._previous_sr_status = content
+            self.sr_status_stale = False
+            self.fetch_policy.success()
+            self.function_counter("sr_status.requests.ok")
             # self.pm.hook.update_sr_status(content=self._previous_sr_status)
         else:
-            logging.error(f"(SR API) {response.status_code}: {response.text}")
-            self.function_counter(inspect.currentframe().f_code.co_name + ".requests.error")
+            logging.error("(SR API) %s: %.200s", status_code, text)
+            self.sr_status_stale = True
+            self.fetch_policy.failure()
+            self.function_counter("sr_status.requests.error")
 
         return self._previous_sr_status
 
@@ -141,15 +401,17 @@ class SRPusher(Config):
         return []
 
     def map_member_room(self, content: dict) -> None:
-        self._all_members = {}
+        """ count rooms of every (interned) user, more than 1 if logged in twice.
+            Members without userId (e.g. the bot of the official room) are counted as one member, id 0 (never interned), as before.
+        """
         try:
-            for room in content["rooms"]:
-                for member in room["members"]:
-                    prev = self._all_members.get(member["userId"])
-                    prev = prev if prev is not None else 0
-                    self._all_members[member["userId"]] = 1 + prev
+            members = [member for room in content["rooms"] for member in room["members"]]
         except KeyError:
-            pass
+            members = []
+        userids = [member["userId"].lower() for member in members if member.get("userId")]
+        self._all_members = collections.Counter(self.intern.intern(userids))
+        if len(userids) < len(members):
+            self._all_members[0] = len(members) - len(userids)
 
     def send_notification(self, message: str, title: str) -> bool:
         """ Send notification via pushover """
@@ -159,7 +421,7 @@ class SRPusher(Config):
             return False
         if not message or not type(message) is str:
             return False
-        logging.debug(f"(Send PushOver) {title}: {message.strip()}")
+        logging.debug("(Send PushOver) %s: %s", title, message)
         self.function_counter(inspect.currentframe().f_code.co_name + ".sent")
         return self.pushover.send_message(message.strip(), title=title)
 
@@ -168,30 +430,83 @@ class SRPusher(Config):
         self.redis.set(key, time.time())
         self.redis.expire(key, expire)
 
-    def get_users_diff(self, key1, key2) -> list:
-        """ Get offline<=>online of users diff from redis """
-        self.function_counter(inspect.currentframe().f_code.co_name)
-        return list(self.redis.sdiff(key1, key2))
+    def load_online_ids(self) -> set:
+        """ Online users of the previous cycle from redis (run once mode, or a new leader).
+            Falls back to the set of userIds written by older versions.
+        """
+        ids = self.redis.smembers(self.key_members_ids)
+        if ids:
+            return {int(id) for id in ids}
+        return set(self.intern.intern(list(self.redis.smembers(self.key_members_previous))))
 
 
-    def set_users_status(self, key, userids) -> None:
-        """ Set users online status in redis """
+    def diff_online_ids(self, online_ids: set) -> Tuple[set, set]:
+        """ (onlined, offlined) interned ids against the previous cycle, compared in memory.
+            Only the difference is written to redis, except for the first cycle of the process.
+        """
         self.function_counter(inspect.currentframe().f_code.co_name)
-        self.redis.delete(key)
-        for userid in userids:
-            if str(userid) and userid != '':
-                self.redis.sadd(key, userid.lower())
-        self.redis.expire(key, 60 * 60 * 24 * 7)
-
+        loaded = self._online_ids is None
+        online_ids_prev = self.load_online_ids() if loaded else self._online_ids
+        onlined = online_ids - online_ids_prev
+        offlined = online_ids_prev - online_ids
+
+        def ops(pipe):
+            if loaded:
+                pipe.delete(self.key_members_ids, self.key_members, self.key_members_previous)
+                if online_ids:
+                    pipe.sadd(self.key_members_ids, *online_ids)
+            else:
+                if offlined:
+                    pipe.srem(self.key_members_ids, *offlined)
+                if onlined:
+                    pipe.sadd(self.key_members_ids, *onlined)
+            pipe.expire(self.key_members_ids, 60 * 60 * 24 * 7)
+        self.fenced_write(ops)
+        self._online_ids = online_ids
+        return onlined, offlined
+
+
+    def fenced_write(self, ops) -> None:
+        """ Commit state writes, `ops(pipe)` queues commands into the pipeline.
+            With leader election, the writes are a transaction on the lease, and are aborted if the lease has been taken over.
+            Within fenced_cycle(), the writes are deferred and committed together at its end.
+        """
+        if self._fenced_ops is not None:
+            self._fenced_ops.append(ops)
+            return
+        if self.lease is None:
+            pipe = self.redis.pipeline(transaction=True)
+            ops(pipe)
+            pipe.execute()
+            return
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(self.lease.key_lease)
+                if self.lease.token is None or pipe.get(self.lease.key_lease) != self.lease.value:
+                    raise LeaseLostError(self.lease.value)
+                pipe.multi()
+                ops(pipe)
+                pipe.execute()
+            except redis.WatchError:
+                raise LeaseLostError(self.lease.value)
+
+
+    @contextlib.contextmanager
+    def fenced_cycle(self):
+        """ Commit the state writes of a cycle in one fenced write, all or nothing.
+            A leader which loses the lease midway commits none of them, so the new leader emits the transitions again.
+        """
+        self._fenced_ops = []
+        try:
+            yield
+            deferred = self._fenced_ops
+        finally:
+            self._fenced_ops = None
 
-    def flush_users_status(self, key_src: str, key_dest: str) -> None:
-        """ Flush user online status for next comparing """
-        # swap and flush!
-        self.redis.delete(key_dest)
-        self.redis.sinterstore(key_dest, key_src)
-        if not self.debug:
-            self.redis.delete(key_src)
-        self.redis.expire(key_dest, 60 * 60 * 24 * 7)
+        def ops(pipe):
+            for o in deferred:
+                o(pipe)
+        self.fenced_write(ops)
 
 
     def set_user_cache(self, user: object, isonline=True) -> None:
@@ -205,6 +520,9 @@ class SRPusher(Config):
             return
         key = self.header_usercache + userid.lower()
         user["online"] = isonline
+        if self.cache is not None:
+            self.cache.set(key, json.dumps(user), ex=60 * 60)
+            return
         self.redis.set(key, json.dumps(user))
         self.redis.expire(key, 60 * 60)  # shorter is ok, at least it should remain until the next fetch.
 
@@ -213,33 +531,70 @@ class SRPusher(Config):
         """ Cache room detail in redis """
         self.function_counter(inspect.currentframe().f_code.co_name)
         key = self.header_roomcache + roomid
+        if self.cache is not None:
+            self.cache.set(key, json.dumps(room_object), ex=60 * 60)
+            return
         self.redis.set(key, json.dumps(room_object))
         self.redis.expire(key, 60 * 60)
 
 
     def get_room_cache(self, roomid: str) -> object:
         """ Get room's detail cache from redis if exists (unreliable) """
-        self.function_counter(inspect.currentframe().f_code.co_name)
+        if self.cache is not None:
+            self.cache.counter[inspect.currentframe().f_code.co_name] += 1  # no round trip for a hit
+        else:
+            self.function_counter(inspect.currentframe().f_code.co_name)
         if roomid is None:
             return {}
         key = self.header_roomcache + roomid
         try:
-            roomcache = json.loads(self.redis.get(key))
+            roomcache = json.loads(self.cache.get(key) if self.cache is not None else self.redis.get(key))
         except TypeError:
             roomcache = {}
         return roomcache
 
     def get_user_cache(self, userid: str) -> object:
         """ Get user's detail cache from redis if exists (unreliable) """
-        self.function_counter(inspect.currentframe().f_code.co_name)
+        if self.cache is not None:
+            self.cache.counter[inspect.currentframe().f_code.co_name] += 1  # no round trip for a hit
+        else:
+            self.function_counter(inspect.currentframe().f_code.co_name)
         key = self.header_usercache + userid.lower()
         try:
-            usercache = json.loads(self.redis.get(key))
+            usercache = json.loads(self.cache.get(key) if self.cache is not None else self.redis.get(key))
         except TypeError:
             usercache = {}
         return usercache
 
 
+    def user_digest(self, user: dict) -> str:
+        """ 64bit digest of the fields that check_user_diff compares: nickname, iconInfo and roomid """
+        fields = json.dumps([user.get("nickname"), user.get("iconInfo"), user.get("roomid")], sort_keys=True)
+        return str(int.from_bytes(hashlib.blake2b(fields.encode('utf-8'), digest_size=8).digest(), 'big'))
+
+
+    def get_user_digests(self, userids: list) -> dict:
+        """ Get digests of users from redis at once """
+        if not userids:
+            return {}
+        return dict(zip(userids, self.redis.hmget(self.key_user_digest, userids)))
+
+
+    def set_user_digests(self, digests: dict, offlined_userids: list = ()) -> None:
+        """ Set (changed) digests of users in redis at once, and remove the ones of offlined users, so only online users are kept.
+            The expiry is refreshed every cycle, also when nothing has changed.
+        """
+        offlined_userids = [userid for userid in offlined_userids if userid]
+
+        def ops(pipe):
+            if offlined_userids:
+                pipe.hdel(self.key_user_digest, *offlined_userids)
+            if digests:
+                pipe.hset(self.key_user_digest, mapping=digests)
+            pipe.expire(self.key_user_digest, 60 * 60)  # same as user cache
+        self.fenced_write(ops)
+
+
     def check_user_diff(self, user: dict, room: dict) -> None:
         """ Compare user object against cache and evaluate hook if it has changed """
         self.function_counter(inspect.currentframe().f_code.co_name)
@@ -253,9 +608,9 @@ class SRPusher(Config):
             # client under v1.5 or testroom
             return
 
-        if self._all_members.get(userid) and self._all_members.get(userid) > 1:
+        if self._all_members.get(self.intern.ids.get(userid.lower()), 0) > 1:
             room_dup = True
-            logging.debug("room dup: " + user.get("nickname"))
+            logging.debug("room dup: %s", user.get("nickname"))
         else:
             room_dup = False
         """ 1. nickname has changed
@@ -263,7 +618,7 @@ class SRPusher(Config):
             3. roomid has changed but offline -> online (because it's normal) or one user has multiple logged in whether in different room or the same room(it's not normal but happens).
         """
         if user_prev.get("nickname") != user.get("nickname") or \
-           user_prev["iconInfo"] != user["iconInfo"] or \
+           user_prev.get("iconInfo") != user.get("iconInfo") or \
            (not (user_prev.get("online") is False and user.get("online") is True) and
                 room_dup is False and user_prev.get("roomid") != '' and user.get("roomid") != '' and user_prev.get("roomid") != user.get("roomid")):
             self.pm.hook.change_user_status(user=user, user_prev=user_prev, room=room)
@@ -286,24 +641,29 @@ class SRPusher(Config):
     def set_rooms_status(self, key, roomids) -> None:
         """ Set rooms alive in redis """
         self.function_counter(inspect.currentframe().f_code.co_name)
-        self.redis.delete(key)
-        for roomid in roomids:
-            if str(roomid) and roomid != '':
-                self.redis.sadd(key, roomid)
-        self.redis.expire(key, 60 * 60 * 24 * 7)
+
+        def ops(pipe):
+            pipe.delete(key)
+            for roomid in roomids:
+                if str(roomid) and roomid != '':
+                    pipe.sadd(key, roomid)
+            pipe.expire(key, 60 * 60 * 24 * 7)
+        self.fenced_write(ops)
 
     def flush_rooms_status(self, key_src: str, key_dest: str) -> None:
         """ Flush rooms alive for next comparing """
-        self.redis.delete(key_dest)
-        self.redis.sinterstore(key_dest, key_src)
-        if not self.debug:
-            self.redis.delete(key_src)
-        self.redis.expire(key_dest, 60 * 60 * 24 * 7)
+        def ops(pipe):
+            pipe.delete(key_dest)
+            pipe.sinterstore(key_dest, key_src)
+            if not self.debug:
+                pipe.delete(key_src)
+            pipe.expire(key_dest, 60 * 60 * 24 * 7)
+        self.fenced_write(ops)
 
     def srpprint(self, users: list, style: str = '') -> None:
         """ sr pprint for debug """
         for userid in users:
-            logging.info(userid + (self.get_user_cache(userid).get("nickname") if dict(self.get_user_cache(userid)) else ''))
+            logging.info("%s%s", userid, self.get_user_cache(userid).get("nickname") or '')
 
 
     def check_notify_duplicated(self, keyword: str) -> bool:
@@ -341,28 +701,45 @@ class SRPusher(Config):
         online_members = []
         alive_rooms = []
         private_rooms_count = 0
+        # compare digests first, the user cache is read only if the digest has changed
+        userids = [m.get("userId").lower() for room in content["rooms"] for m in room["members"] if m.get("userId")]
+        ids = dict(zip(userids, self.intern.intern(userids)))
+        digests = self.get_user_digests(userids)
+        digests_new = {}
         for room in content["rooms"]:
             roomname = room.get("roomName")
-            createTime = dateutil.parser.parse(room.get("createTime"))
+            createTime = parse_createtime(room.get("createTime"))
             nsgmmemberid = room.get("creator").get("nsgmMemberId") or ''  # actionid
             roomid = self.generate_roomid(createTime, roomname, nsgmmemberid)
             if room.get("needPasswd"):
                 private_rooms_count += 1
             alive_rooms.append(roomid)
+            self.current_rooms[roomid] = room
+            self.room_members[roomid] = array.array('L', [ids[m["userId"].lower()] for m in room["members"] if m.get("userId")])
             self.set_room_cache(roomid, room)
             for m in room["members"]:
                 userid = m.get("userId")
                 m["roomid"] = roomid  # for user->room lookup
                 m["online"] = True
                 online_members.append(userid)
-                self.check_user_diff(user=m, room=room)  # check user diff. the room object is for optional information
+                if userid:
+                    digest = self.user_digest(m)
+                    if digests.get(userid.lower()) != digest:
+                        self.check_user_diff(user=m, room=room)  # check user diff. the room object is for optional information
+                        digests[userid.lower()] = digests_new[userid.lower()] = digest
                 self.set_user_cache(user=m, isonline=True)
+        self.user_digests_new.update(digests_new)  # written with the offlined users, after the diff
+        self.function_counter("check_user_diff.digest", len(digests_new))
         return online_members, alive_rooms, private_rooms_count
 
 
     def check_sr_status_diff(self, content: dict, content_option=None) -> Tuple[list, list, list, list, list]:
         # pass 1
-        online_members, alive_rooms, private_rooms_count = self.get_onlines(content)
+        self.current_rooms = {}
+        self.room_members = {}
+        self.user_digests_new = {}
+        _, alive_rooms, private_rooms_count = self.get_onlines(content)
+        online_ids = set().union(*self.room_members.values())
         self.redis_touch("last_fetch", 60 * 10)
         if content_option:
             _, alive_rooms_option, private_rooms_count = self.get_onlines(content=content_option)
@@ -370,25 +747,34 @@ class SRPusher(Config):
         else:
             _, alive_rooms_option = ([], [])
 
-        # set current users to `current` list
-        self.set_users_status(self.key_members, online_members)
-        # compare current list with `previous` list
-        offlined_users = self.get_users_diff(self.key_members_previous, self.key_members)
-        onlined_users = self.get_users_diff(self.key_members, self.key_members_previous)
-        # flush previous list with current list
-        self.flush_users_status(self.key_members, self.key_members_previous)
-
-        # also
+        # compare current users with the previous ones, on interned ids
+        onlined_ids, offlined_ids = self.diff_online_ids(online_ids)
+        if self.presence is not None:
+            self.presence.record_ids(online_ids, onlined_ids)
+        # hooks get userIds
+        onlined_users = self.intern.userids_of(sorted(onlined_ids))
+        offlined_users = self.intern.userids_of(sorted(offlined_ids))
+        self.set_user_digests(self.user_digests_new, offlined_users)
+
+        # also, compared in memory: the writes are not committed until the end of the cycle
+        rooms = {roomid for roomid in alive_rooms if roomid}
+        rooms_previous = self.redis.smembers(self.key_rooms_previous)
         self.set_rooms_status(self.key_rooms, alive_rooms)
-        offlined_rooms = self.get_rooms_diff(self.key_rooms_previous, self.key_rooms)
+        offlined_rooms = list(rooms_previous - rooms)
         if content_option and len(alive_rooms_option) > 0:
             self.set_rooms_status(self.key_rooms_option, alive_rooms_option)
-            option_rooms = self.get_rooms_diff(self.key_rooms, self.key_rooms_option)
+            option_rooms = list(rooms - set(alive_rooms_option))
         else:
             option_rooms = []
-        onlined_rooms = self.get_rooms_diff(self.key_rooms, self.key_rooms_previous)
+        onlined_rooms = list(rooms - rooms_previous)
         self.flush_rooms_status(self.key_rooms, self.key_rooms_previous)
 
+        # hysteresis, suppress users and rooms that come and go in a moment
+        onlined_users, offlined_users = self.debounce_users.filter(onlined_users, offlined_users)
+        onlined_rooms, offlined_rooms = self.debounce_rooms.filter(onlined_rooms, offlined_rooms)
+        if self.lag is not None:
+            self.lag.detected(onlined_rooms, onlined_users, first_seen=self.debounce_users.first_seen)
+
         # stats
         self.function_counter(inspect.currentframe().f_code.co_name + ".onlined_users", len(onlined_users))
         self.function_counter(inspect.currentframe().f_code.co_name + ".offlined_users", len(offlined_users))
@@ -404,6 +790,7 @@ class SRPusher(Config):
         # pass 2
         nowtime = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
         new_rooms_text = {}
+        onlined_users = set(onlined_users)
         for room in content["rooms"]:
             messages = []
             is_new_room = False
@@ -412,13 +799,13 @@ class SRPusher(Config):
             numMembers = room.get("numMembers")
             needPasswd = room.get("needPasswd")
             members = room.get("members")
-            createTime = dateutil.parser.parse(room.get("createTime"))
+            createTime = parse_createtime(room.get("createTime"))
             nsgmmemberid = room.get("creator").get("nsgmMemberId") or ''  # actionid
             roomid = self.generate_roomid(createTime, roomname, nsgmmemberid)
             if self.check_keyword(roomname, roomdesc, members=members):
                 is_new_room = True
                 messages.append("keyword: {} {}".format(roomname, roomdesc))
-                logging.debug("keyword: {} {}".format(roomname, roomdesc))
+                logging.debug("keyword: %s %s", roomname, roomdesc)
             room_members = ""
             for m in room["members"]:
                 nickname = m.get("nickname")
@@ -427,8 +814,8 @@ class SRPusher(Config):
                 if self.check_keyword(nickname, members=members):
                     is_new_room = True
                     messages.append("keyword: {} {}".format(roomname, roomdesc))
-                    logging.debug("keyword: {}".format(nickname))
-                if userid in list(onlined_users) and userid in self.settings["sr"]["targets"]:
+                    logging.debug("keyword: %s", nickname)
+                if userid in onlined_users and userid in self.settings["sr"]["targets"]:
                     header = "  + "  # online-ed now
                 elif userid in self.settings["sr"]["targets"]:
                     header = "  * "  # pinned
@@ -443,8 +830,9 @@ class SRPusher(Config):
                     room_members_text['room'] = '{}{}'.format(roomname, ' (protected)' if needPasswd else '')
                     room_members_text['detail'] = 'Members({}):\n{}\n{}\nElapsed: {}\n\n'.format(numMembers, room_members, roomdesc, (nowtime - createTime))
                     new_rooms_text[roomid] = room_members_text
-                if messages:
-                    self.pm.hook.hit_keyword(messages=messages, keyword=None)
+            if messages:
+                # once per room, a keyword in nicknames appends the same message for every member who has it
+                self.pm.hook.hit_keyword(messages=list(dict.fromkeys(messages)), keyword=None)
 
         return new_rooms_text
 
@@ -452,12 +840,33 @@ class SRPusher(Config):
         """ Check SR status and send notification if needed """
         content_option = self.sr_status_option
         content = self.sr_status
+        if self.sr_status_stale:
+            logging.warning("(SR API) no new status, skip this cycle.")
+            self.function_counter("check_sr_status.stale")
+            return False
+        new_rooms_text = self.process_sr_status(content, content_option=content_option)
+        self.deliver_notifications(new_rooms_text)
+        return True
+
+
+    def process_sr_status(self, content: dict, content_option=None) -> dict:
+        """ Compare the status with the previous one and evaluate hooks, returns notifications to send """
+        if self.stream is not None:
+            self.stream.discard()  # events of a cycle which has been aborted (e.g. the lease has been lost)
         self.map_member_room(content=content)
         self.pm.hook.change_count_user(count=len(self._all_members))
-        logging.info(f"{len(self.sr_status.get('rooms'))} rooms, {len(self._all_members)} membres are online.")
+        logging.info("%d rooms, %d membres are online.", len(content.get('rooms')), len(self._all_members))
 
-        onlined_users, offlined_users, onlined_rooms, offlined_rooms, option_rooms = self.check_sr_status_diff(content, content_option=content_option)
+        # the state of the cycle is committed at once, before any hook of its transitions is evaluated
+        with self.fenced_cycle():
+            onlined_users, offlined_users, onlined_rooms, offlined_rooms, option_rooms = self.check_sr_status_diff(content, content_option=content_option)
+            if self.room_stats is not None:
+                self.room_stats.update(self.current_rooms, onlined_users, onlined_rooms, offlined_rooms)
         new_rooms_text = self.check_sr_status_members(content=content, onlined_users=onlined_users)
+        if self.lag is not None:
+            self.lag.notifying(list(new_rooms_text), onlined_rooms)
+        if self.api is not None and self.api.server is not None:
+            self.api.update(self.current_rooms)  # not in run once mode, nothing would query it
 
         if len(onlined_rooms):
             for r in onlined_rooms:
@@ -479,12 +888,29 @@ class SRPusher(Config):
                 room = self.get_room_cache(roomid)
                 self.pm.hook.offlined_user(user=self.get_user_cache(u).copy(), room=room, roomid=roomid)
                 self.set_user_cache(user=self.get_room_cache(u), isonline=False)
+        if self.stream is not None:
+            self.stream.flush()
+        if self.cache is not None:
+            self.cache.flush_metrics()
+        if self.lag is not None:
+            self.lag.report()
+        return new_rooms_text
+
+
+    def deliver_notifications(self, new_rooms_text: dict) -> None:
+        """ Send notifications of new rooms """
         for k, v in new_rooms_text.items():
-            result = self.send_notification(v['detail'], title=v['room'])
-            if result:
-                room = self.get_room_cache(k)
-                self.pm.hook.send_pushover(message=v['detail'], title=v['room'], room=room, roomid=k)
-            logging.info(str(result))
+            self.notified(k, v, self.send_notification(v['detail'], title=v['room']))
+
+
+    def notified(self, roomid: str, room_text: dict, result: bool) -> None:
+        """ Evaluate hook after a notification """
+        if result and self.lag is not None:
+            self.lag.delivered(roomid)
+        if result:
+            room = self.get_room_cache(roomid)
+            self.pm.hook.send_pushover(message=room_text['detail'], title=room_text['room'], room=room, roomid=roomid)
+        logging.info("%s", result)
 
 
     def redis_copy(self, key_dest: str, key_src: str) -> None:
@@ -512,7 +938,7 @@ class SRPusher(Config):
         # max_wait_sec = 60 * 3
         jitter_sec = random.gauss(mu=jitter_mu, sigma=jitter_sigma)
         wait_sec = users * multiplier + intercept
-        logging.debug("wait_sec %d = %d * %.2f + %d +(%d) " % (wait_sec, users, multiplier, intercept, jitter_sec))
+        logging.debug("wait_sec %d = %d * %.2f + %d +(%d) ", wait_sec, users, multiplier, intercept, jitter_sec)
         # wait_sec = wait_sec if wait_sec > min_wait_sec else min_wait_sec + jitter_sec  # add jitter if clamped below minimum seconds
         raw_sec = wait_sec if wait_sec > min_wait_sec_abs else min_wait_sec_abs  # just for stats, no jitter
         wait_sec = wait_sec + jitter_sec  # add jitter if clamped below minimum seconds
@@ -533,38 +959,102 @@ class SRPusher(Config):
         self.redis.set("prev_wait_sec", value)
 
 
-    def run(self, runonce=False) -> None:
-        """ default first runner """
-        base_wait_sec = float(self.settings["sr"]["api_duration_sec"])
-        prev_wait_sec = base_wait_sec
-        while True:
-            self.check_sr_status()
+    def standby(self, runonce=False) -> bool:
+        """ Wait as a standby until the lease is acquired, return False if runonce and this is not the leader """
+        ha = self.settings.get('ha') or {}
+        standby_poll_sec = float(ha.get('standby_poll_sec', self.settings["sr"]["api_duration_dynamic"]["min_wait_sec_absolute"]))
+        token = self.lease.token
+        while not self.lease.acquire():
             if runonce:
+                logging.info("(Leader) another instance is the leader, skip.")
+                return False
+            logging.debug("(Leader) standby, retry after %s sec.", standby_poll_sec)
+            time.sleep(standby_poll_sec)
+        if self.lease.token != token:
+            # a new term, another instance may have written the state meanwhile: read it from redis again
+            self._online_ids = None
+            self.debounce_users.pending = self.debounce_rooms.pending = None
+            if self.room_stats is not None:
+                self.room_stats.reset()
+        return True
+
+
+    def next_wait_sec(self) -> float:
+        """ Seconds to wait until the next cycle, from count(user) and smoothed """
+        prev_wait_sec = self.previous_wait_sec
+        # (wait_sec, jitter_calc) = self.dyn_wait_sec(len(self._all_members) * (60 / prev_wait_sec))  # normalize /min
+        (wait_sec, jitter_calc, raw_sec) = self.dyn_wait_sec(len(self._all_members))
+        wait_sec = self.lpf(prev_wait_sec, wait_sec)
+        if self.lag is not None:
+            wait_sec = self.lag.cap_wait_sec(wait_sec, float(self.settings["sr"]["api_duration_dynamic"]["min_wait_sec_absolute"]))
+        self.previous_wait_sec = wait_sec
+        logging.info("wait_sec: %d jitter(%d) exact:%d", wait_sec, jitter_calc, raw_sec)
+        self.function_gauge("run.sleep_sec", wait_sec)
+        self.function_gauge("run.estimated_sleep_sec", raw_sec)
+        return wait_sec
+
+
+    def flush_stats(self) -> None:
+        """ Evaluate stats hooks and rotate counters """
+        if self._previous_sr_status is not None:
+            self.pm.hook.change_count_room(count=len(self._previous_sr_status.get('rooms')))
+        self.pm.hook.py_function_count(counter=self.redis.hgetall(self.key_func_count), counter_prev=self.redis.hgetall(self.key_func_count_previous))
+        self.redis_copy(key_dest=self.key_func_count_previous, key_src=self.key_func_count)
+        self.redis.hset(self.key_func_count_previous, "run.previous_epoch", time.time())
+
+        self.pm.hook.py_function_gauge(gauge=self.redis.hgetall(self.key_func_gauge))
+        self.redis.delete(self.key_func_gauge)
+
+
+    def sleep(self, wait_sec: float) -> None:
+        """ Wait until the next cycle. The leader renews the lease every third of `ha: lease_ttl_sec` meanwhile,
+            so a standby takes over within the ttl if this process dies, however long the interval is.
+            Returns early if the lease has been lost, to go standby.
+        """
+        if self.lease is None:
+            time.sleep(wait_sec)
+            return
+        until = time.time() + wait_sec
+        while self.lease.acquire():
+            remaining = until - time.time()
+            if remaining <= 0:
                 return
-            jitter = random.uniform(1 - float(self.settings["sr"]["api_duration_jitter"]), 1 + self.settings["sr"]["api_duration_jitter"])
-            logging.debug(f"{len(self.sr_status.get('rooms'))} rooms available.")
+            time.sleep(min(remaining, self.lease.ttl_sec / 3))
 
-            prev_wait_sec = self.previous_wait_sec
-            # (wait_sec, jitter_calc) = self.dyn_wait_sec(len(self._all_members) * (60 / prev_wait_sec))  # normalize /min
-            (wait_sec, jitter_calc, raw_sec) = self.dyn_wait_sec(len(self._all_members))
-            wait_sec = self.lpf(prev_wait_sec, wait_sec)
-            prev_wait_sec = wait_sec
-            self.previous_wait_sec = wait_sec
-            logging.info("wait_sec: %d jitter(%d) exact:%d" % (wait_sec, jitter_calc, raw_sec))
 
+    def run(self, runonce=False, engine=None) -> None:
+        """ default first runner
+            engine: "async" runs the asyncio engine (srpusher_async), or the setting `global: engine`
+        """
+        engine = engine or self.settings['global'].get('engine')
+        if engine == "async":
+            import asyncio
+            from srpusher_async import AsyncEngine
+            return asyncio.run(AsyncEngine(parent=self).run(runonce))
+
+        if self.api is not None and not runonce:
+            self.api.start()
+        if self.cache is not None and not runonce:
+            self.cache.start()  # a process of run once mode would never hit
+        while True:
+            if self.lease is not None and not self.standby(runonce):
+                return
+            try:
+                self.check_sr_status()
+            except LeaseLostError:
+                logging.warning("(Leader) the lease has been taken over, discard this cycle.")
+                self.lease.token = None
+                self._online_ids = None
+                continue
+            if runonce:
+                if self.lease is not None:
+                    self.lease.release()
+                return
+            # after errors, wait at least until the fetch policy allows the next request
+            wait_sec = max(self.next_wait_sec(), self.fetch_policy.delay())
             # stats
-            self.pm.hook.change_count_room(count=len(self.sr_status.get('rooms')))
-            self.function_gauge(inspect.currentframe().f_code.co_name + ".sleep_sec", wait_sec)
-            self.function_gauge(inspect.currentframe().f_code.co_name + ".estimated_sleep_sec", raw_sec)
-            self.pm.hook.py_function_count(counter=self.redis.hgetall(self.key_func_count), counter_prev=self.redis.hgetall(self.key_func_count_previous))
-            self.redis_copy(key_dest=self.key_func_count_previous, key_src=self.key_func_count)
-            self.redis.hset(self.key_func_count_previous, "run.previous_epoch", time.time())
-
-            self.pm.hook.py_function_gauge(gauge=self.redis.hgetall(self.key_func_gauge))
-            self.redis.delete(self.key_func_gauge)
-
-            # time.sleep(base_wait_sec * jitter)
-            time.sleep(wait_sec)
+            self.flush_stats()
+            self.sleep(wait_sec)
 
 
     """ format plugin decorators and hooks """
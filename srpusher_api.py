@@ -0,0 +1,178 @@
+#! venv/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 sts=4 ff=unix ft=python expandtab
+
+"""
+    Read-only local query API, served from the snapshot of the last cycle. No redis access.
+
+    GET /counts                 -> {"users": int, "rooms": int, "private_rooms": int, "epoch": float}
+    GET /rooms                  -> [{"roomid", "roomName", "numMembers", "needPasswd"}]
+    GET /rooms/<roomid>         -> {"roomid", "room"}
+    GET /users/<userid>         -> {"userid", "user", "rooms": [roomid]}
+    GET /search?q=<text>        -> {"users": [{"userid", "nickname", "rooms"}], "rooms": [{"roomid", "roomName"}]}
+"""
+import os
+import json
+import stat
+import time
+import logging
+import threading
+import urllib.parse
+import http.server
+import socketserver
+
+
+def trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class Snapshot(object):
+    """ Online users and rooms at one cycle, with a trigram index of nicknames and room names """
+    def __init__(self, rooms: dict) -> None:
+        """ rooms: {roomid: room object of API} """
+        self.epoch = time.time()
+        self.rooms = rooms
+        self.users = {}  # userid -> member object
+        self.user_rooms = {}  # userid -> [roomid], a user may be logged in twice
+        self.private_rooms = 0
+        self.names = {}  # ("user"|"room", id) -> lowercased name
+        self.index = {}  # trigram -> {("user"|"room", id)}
+        for roomid, room in rooms.items():
+            if room.get("needPasswd"):
+                self.private_rooms += 1
+            self.add_name(("room", roomid), room.get("roomName"))
+            for m in room.get("members") or []:
+                userid = (m.get("userId") or "").lower()
+                if not userid:
+                    continue
+                self.users[userid] = m
+                self.user_rooms.setdefault(userid, []).append(roomid)
+                self.add_name(("user", userid), m.get("nickname"))
+
+    def add_name(self, entry: tuple, name: str) -> None:
+        if not name:
+            return
+        name = name.lower()
+        self.names[entry] = name
+        for t in trigrams(name):
+            self.index.setdefault(t, set()).add(entry)
+
+    def search(self, text: str, limit: int = 50) -> list:
+        """ entries whose name contains text (case insensitive), ordered by name then id, so a limited result is stable """
+        text = text.lower()
+        if len(text) < 3:
+            candidates = self.names.keys()
+        else:
+            candidates = None
+            for t in trigrams(text):
+                entries = self.index.get(t, set())
+                candidates = entries if candidates is None else candidates & entries
+                if not candidates:
+                    return []
+        return sorted((entry for entry in candidates if text in self.names[entry]), key=lambda entry: (self.names[entry], entry))[:limit]
+
+    def counts(self) -> dict:
+        return {"users": len(self.users), "rooms": len(self.rooms), "private_rooms": self.private_rooms, "epoch": self.epoch}
+
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    """ GET only, JSON """
+    server_version = "srpusher"
+
+    def address_string(self) -> str:
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args) -> None:
+        logging.debug("(API) %s %s", self.address_string(), format % args)
+
+    def reply(self, code: int, body: object) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        snapshot = self.server.api.snapshot
+        if snapshot is None:
+            return self.reply(503, {"error": "no snapshot yet"})
+        url = urllib.parse.urlsplit(self.path)
+        path = [urllib.parse.unquote(p) for p in url.path.split("/") if p]
+        if path == ["counts"]:
+            return self.reply(200, snapshot.counts())
+        if path == ["rooms"]:
+            return self.reply(200, [
+                {"roomid": roomid, "roomName": room.get("roomName"), "numMembers": room.get("numMembers"), "needPasswd": room.get("needPasswd")}
+                for roomid, room in snapshot.rooms.items()
+            ])
+        if len(path) == 2 and path[0] == "rooms":
+            room = snapshot.rooms.get(path[1])
+            if room is None:
+                return self.reply(404, {"error": "room not found"})
+            return self.reply(200, {"roomid": path[1], "room": room})
+        if len(path) == 2 and path[0] == "users":
+            userid = path[1].lower()
+            user = snapshot.users.get(userid)
+            if user is None:
+                return self.reply(404, {"error": "user not online"})
+            return self.reply(200, {"userid": userid, "user": user, "rooms": snapshot.user_rooms.get(userid)})
+        if path == ["search"]:
+            q = urllib.parse.parse_qs(url.query).get("q", [""])[0]
+            if not q:
+                return self.reply(400, {"error": "q is required"})
+            result = {"users": [], "rooms": []}
+            for kind, id in snapshot.search(q):
+                if kind == "user":
+                    result["users"].append({"userid": id, "nickname": snapshot.users[id].get("nickname"), "rooms": snapshot.user_rooms.get(id)})
+                else:
+                    result["rooms"].append({"roomid": id, "roomName": snapshot.rooms[id].get("roomName")})
+            return self.reply(200, result)
+        return self.reply(404, {"error": "not found"})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+class QueryAPI(object):
+    """ Serve the snapshot over HTTP on `api: bind`, `host:port` or `unix:/path/to/socket` """
+    snapshot = None
+    server = None
+
+    def __init__(self, parent=None) -> None:
+        self.parent = parent
+        settings = parent.settings.get("api") or {}
+        self.bind = str(settings.get("bind", "127.0.0.1:8765"))
+
+    def update(self, rooms: dict) -> None:
+        """ Replace the snapshot, readers keep the previous one until they finish """
+        t = time.time()
+        self.snapshot = Snapshot(rooms)
+        self.parent.function_gauge("api.update_sec", time.time() - t)
+
+    def start(self) -> None:
+        if self.bind.startswith("unix:"):
+            path = self.bind[len("unix:"):]
+            try:
+                if stat.S_ISSOCK(os.stat(path).st_mode):
+                    os.unlink(path)  # left by a previous process, any other file is not ours to remove
+            except FileNotFoundError:
+                pass
+            self.server = ThreadingUnixHTTPServer(path, QueryHandler)
+        else:
+            host, _, port = self.bind.rpartition(":")
+            self.server = http.server.ThreadingHTTPServer((host, int(port)), QueryHandler)
+        self.server.api = self
+        threading.Thread(target=self.server.serve_forever, name="srpusher-api", daemon=True).start()
+        logging.info("(API) listening on %s", self.bind)
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
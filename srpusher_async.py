@@ -0,0 +1,170 @@
+#! venv/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 sts=4 ff=unix ft=python expandtab
+
+"""
+    asyncio engine, `SRPusher.run(engine="async")`.
+
+    - SR API is fetched with aiohttp (or requests in a thread if aiohttp is not installed).
+    - Notifications are sent concurrently, stats are read from redis concurrently with redis.asyncio.
+    - The next fetch starts while notifications and stats of the previous cycle are still in progress.
+      The previous cycle is always finished before the next one is processed, so hooks are never evaluated concurrently.
+    - Comparing the status and evaluating hooks stays synchronous (SRPusher.process_sr_status), in a worker thread.
+"""
+import time
+import asyncio
+import logging
+import requests
+import redis.asyncio
+
+from srpusher import LeaseLostError
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+fetch_errors = (requests.RequestException, asyncio.TimeoutError) + ((aiohttp.ClientError, ) if aiohttp else ())
+
+
+class AsyncEngine(object):
+    """ Run the cycles of SRPusher on asyncio """
+    session = None
+
+    def __init__(self, parent=None) -> None:
+        self.parent = parent
+        kwargs = parent.redis.connection_pool.connection_kwargs
+        self.redis = redis.asyncio.Redis(
+            host=kwargs.get('host'),
+            port=kwargs.get('port'),
+            db=kwargs.get('db'),
+            encoding="utf-8", decode_responses=True,
+        )
+
+    async def fetch(self) -> dict:
+        """ Fetch SR API, as the policy allows. check `parent.sr_status_stale` """
+        policy = self.parent.fetch_policy
+        if not await asyncio.to_thread(policy.allow):  # the policy state is in redis
+            self.parent.sr_status_stale = True
+            return self.parent._previous_sr_status
+        url, http_headers = self.parent.sr_status_request
+        time_response = time.time()
+        try:
+            if aiohttp is None:
+                response = await asyncio.to_thread(requests.get, url, headers=http_headers, timeout=policy.timeout)
+                status_code, text = response.status_code, response.text
+            else:
+                async with self.session.get(url, headers=http_headers) as response:
+                    status_code, text = response.status, await response.text()
+        except fetch_errors as e:
+            status_code, text = None, str(e) or e.__class__.__name__
+        return await asyncio.to_thread(self.parent.receive_sr_status, status_code, text, time.time() - time_response)
+
+    async def deliver(self, new_rooms_text: dict) -> None:
+        """ Send notifications concurrently, then evaluate hooks in order """
+        results = await asyncio.gather(*[
+            asyncio.to_thread(self.parent.send_notification, v['detail'], title=v['room'])
+            for v in new_rooms_text.values()
+        ], return_exceptions=True)
+        for (k, v), result in zip(new_rooms_text.items(), results):
+            if isinstance(result, Exception):
+                logging.error("(Send PushOver) %s: %s", v['room'], result)
+                result = False
+            await asyncio.to_thread(self.parent.notified, k, v, result)
+
+    async def flush_stats(self, count_room: int = None) -> None:
+        """ SRPusher.flush_stats() while the next cycle is in progress.
+            The counters are read and the gauges are cleared in one transaction, and the previous counters are
+            the counters as read (with their ttl, as redis_copy), so counts written meanwhile are kept for the next flush.
+            count_room: rooms of the cycle, taken before the next fetch replaces the previous status.
+        """
+        p = self.parent
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hgetall(p.key_func_count)
+        pipe.hgetall(p.key_func_count_previous)
+        pipe.hgetall(p.key_func_gauge)
+        pipe.pttl(p.key_func_count)
+        pipe.delete(p.key_func_count_previous, p.key_func_gauge)
+        counter, counter_prev, gauge, pttl, _ = await pipe.execute()
+
+        pipe = self.redis.pipeline(transaction=True)
+        if counter:
+            pipe.hset(p.key_func_count_previous, mapping=counter)
+        pipe.hset(p.key_func_count_previous, "run.previous_epoch", time.time())
+        if pttl > 0:
+            pipe.pexpire(p.key_func_count_previous, pttl)
+        await pipe.execute()
+
+        if count_room is not None:
+            await asyncio.to_thread(p.pm.hook.change_count_room, count=count_room)
+        await asyncio.to_thread(p.pm.hook.py_function_count, counter=counter, counter_prev=counter_prev)
+        await asyncio.to_thread(p.pm.hook.py_function_gauge, gauge=gauge)
+
+    async def downstream(self, new_rooms_text: dict, wait_sec: float, count_room: int = None) -> None:
+        """ Work after a cycle which does not need to finish before the next fetch """
+        await self.deliver(new_rooms_text)
+        if wait_sec is not None:
+            await self.flush_stats(count_room)
+
+    async def sleep(self, wait_sec: float) -> None:
+        """ SRPusher.sleep(): renew the lease every third of its ttl until the next cycle, return early if it has been lost """
+        p = self.parent
+        if p.lease is None:
+            await asyncio.sleep(wait_sec)
+            return
+        until = time.time() + wait_sec
+        while await asyncio.to_thread(p.lease.acquire):
+            remaining = until - time.time()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(min(remaining, p.lease.ttl_sec / 3))
+
+    async def run(self, runonce=False) -> None:
+        p = self.parent
+        if p.api is not None and not runonce:
+            p.api.start()
+        if p.cache is not None and not runonce:
+            p.cache.start()
+        if aiohttp is not None:
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=p.fetch_policy.connect_timeout_sec, sock_read=p.fetch_policy.read_timeout_sec)
+            self.session = aiohttp.ClientSession(timeout=timeout)
+        logging.info("(Async) engine started, %s.", 'aiohttp' if aiohttp else 'requests in threads')
+        downstream = None
+        try:
+            while True:
+                if p.lease is not None and not await asyncio.to_thread(p.standby, runonce):
+                    return
+                fetch = asyncio.create_task(self.fetch())
+                content_option = p.sr_status_option
+                content = await fetch
+                if downstream is not None:
+                    await downstream  # the previous cycle finishes its hooks before this one starts
+                    downstream = None
+                try:
+                    if p.sr_status_stale:
+                        logging.warning("(SR API) no new status, skip this cycle.")
+                        await asyncio.to_thread(p.function_counter, "check_sr_status.stale")
+                        new_rooms_text = {}
+                    else:
+                        new_rooms_text = await asyncio.to_thread(p.process_sr_status, content, content_option)
+                except LeaseLostError:
+                    logging.warning("(Leader) the lease has been taken over, discard this cycle.")
+                    p.lease.token = None
+                    p._online_ids = None
+                    continue
+                if runonce:
+                    await self.downstream(new_rooms_text, None)
+                    if p.lease is not None:
+                        await asyncio.to_thread(p.lease.release)
+                    return
+
+                wait_sec = max(await asyncio.to_thread(p.next_wait_sec), await asyncio.to_thread(p.fetch_policy.delay))
+                count_room = len(p._previous_sr_status.get('rooms')) if p._previous_sr_status is not None else None
+                downstream = asyncio.create_task(self.downstream(new_rooms_text, wait_sec, count_room))
+                await self.sleep(wait_sec)
+        finally:
+            if downstream is not None:
+                await downstream
+            if self.session is not None:
+                await self.session.close()
+            await self.redis.aclose()
@@ -0,0 +1,150 @@
+#! venv/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 sts=4 ff=unix ft=python expandtab
+
+"""
+    Local cache of user and room caches (__usercache__, __roomcache__) in front of redis, invalidated by redis (client side caching, redis >= 6).
+
+    listener -- a connection subscribed to __redis__:invalidate, on a background thread
+    client   -- a single connection that reads and writes the cached keys, with
+                CLIENT TRACKING ON REDIRECT <listener> BCAST PREFIX <prefixes> NOLOOP
+
+    Writes of this process are written through to the local cache, writes of others (a standby, tools) invalidate it.
+    RESP2 redirect mode, as redis-py reads no push messages on a normal connection.
+    If the listener is lost, the local cache is cleared and bypassed.
+"""
+import logging
+import threading
+import collections
+import redis
+
+
+class LocalCache(object):
+    """ LRU of raw values (json strings) of redis keys, bounded by `cache: max_entries` """
+    channel = "__redis__:invalidate"
+    _missing = object()
+    _pending = object()  # a read is in flight, an invalidation meanwhile removes it
+    enabled = False
+    client = None
+    listener = None
+
+    def __init__(self, parent=None, prefixes: tuple = ()) -> None:
+        self.parent = parent
+        settings = parent.settings.get("cache") or {}
+        self.max_entries = int(settings.get("max_entries", 10000))
+        self.prefixes = prefixes
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.counter = collections.Counter()  # counted in memory, flushed once a cycle
+
+    def start(self) -> bool:
+        """ Connect the listener and the client, False if redis does not support tracking """
+        pool = self.parent.redis.connection_pool
+        kwargs = dict(pool.connection_kwargs)
+        try:
+            self.listener = pool.connection_class(**dict(kwargs, socket_timeout=None))
+            self.listener.connect()
+            self.listener.send_command("CLIENT", "ID")
+            self.listener_id = self.listener.read_response()
+            self.listener.send_command("SUBSCRIBE", self.channel)
+            self.listener.read_response()
+            self.client = redis.Redis(
+                connection_pool=redis.ConnectionPool(connection_class=pool.connection_class, redis_connect_func=self.on_connect, **kwargs),
+                single_connection_client=True,
+            )
+        except (redis.RedisError, OSError) as e:
+            logging.warning("(Cache) client side caching is not available: %s", e)
+            if self.listener is not None:
+                self.listener.disconnect()
+            return False
+        self.enabled = True
+        threading.Thread(target=self.listen, name="srpusher-cache", daemon=True).start()
+        logging.info("(Cache) client side caching of %s", ", ".join(self.prefixes))
+        return True
+
+    def on_connect(self, connection) -> None:
+        """ (re)connected: enable tracking again, invalidations may have been missed meanwhile """
+        connection.on_connect()
+        args = ["CLIENT", "TRACKING", "ON", "REDIRECT", self.listener_id, "BCAST"]
+        for prefix in self.prefixes:
+            args += ["PREFIX", prefix]
+        connection.send_command(*args, "NOLOOP")
+        if connection.read_response() != "OK":
+            raise redis.ResponseError("CLIENT TRACKING failed")
+        self.clear()
+
+    def listen(self) -> None:
+        try:
+            while True:
+                message = self.listener.read_response()
+                if message and message[0] == "message":
+                    self.invalidate(message[2])
+        except Exception as e:
+            logging.warning("(Cache) invalidation connection lost, local cache disabled: %s", e)
+            self.enabled = False
+            self.clear()
+
+    def invalidate(self, keys: list) -> None:
+        """ keys: modified keys, or None if the db has been flushed """
+        with self.lock:
+            if keys is None:
+                self.entries.clear()
+                return
+            for key in keys:
+                self.entries.pop(key, None)
+            self.counter["cache.invalidated"] += len(keys)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def put(self, key: str, value: str) -> None:
+        """ lock held. every entry (including a pending read) goes through here, so the size is bounded in one place """
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counter["cache.evicted"] += 1
+
+    def get(self, key: str) -> str:
+        if not self.enabled:
+            return self.parent.redis.get(key)
+        with self.lock:
+            value = self.entries.get(key, self._missing)
+            if value is not self._missing and value is not self._pending:
+                self.entries.move_to_end(key)
+                self.counter["cache.hit"] += 1
+                return value
+            self.put(key, self._pending)
+            self.counter["cache.miss"] += 1
+        value = self._missing
+        try:
+            value = self.client.get(key)
+        finally:
+            with self.lock:
+                if self.entries.get(key) is self._pending:
+                    if value is self._missing:
+                        del self.entries[key]  # the read has failed
+                    else:
+                        self.put(key, value)
+        return value
+
+    def set(self, key: str, value: str, ex: int) -> None:
+        """ write through """
+        if not self.enabled:
+            self.parent.redis.set(key, value, ex=ex)
+            return
+        self.client.set(key, value, ex=ex)
+        with self.lock:
+            self.put(key, value)
+
+    def flush_metrics(self) -> None:
+        """ counters of this cycle to function_counter in one pipeline, entries to function_gauge """
+        with self.lock:
+            counter, self.counter = self.counter, collections.Counter()
+            entries = len(self.entries)
+        pipe = self.parent.redis.pipeline(transaction=False)
+        for fname, count in counter.items():
+            pipe.hincrby(self.parent.key_func_count, fname, count)
+        pipe.hset(self.parent.key_func_gauge, "cache.entries", entries)
+        pipe.execute()
@@ -0,0 +1,86 @@
+#! venv/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 sts=4 ff=unix ft=python expandtab
+
+"""
+    Debouncing of onlined/offlined users and rooms.
+    A transition is emitted after it has lasted for `debounce: cycles` cycles and `debounce: seconds` seconds.
+    A transition reverted before that (a user dropped for a moment) is never emitted.
+"""
+import time
+import logging
+
+
+class Debouncer(object):
+    """ Hysteresis of transitions of one kind of entities (users or rooms).
+        Pending transitions are kept in memory and in a redis hash, for run once mode and for a new leader.
+    """
+    header_debounce = "_sr_debounce_"
+    cycle = 0
+    pending = None  # entity -> (direction +1 onlined / -1 offlined, first cycle, first epoch)
+    first_seen = {}  # entity -> first epoch, of the transitions emitted by the last filter()
+
+    def __init__(self, parent=None, kind: str = "users") -> None:
+        self.parent = parent
+        self.kind = kind
+        self.key = self.header_debounce + kind
+        settings = parent.settings.get("debounce") or {}
+        self.cycles = int(settings.get("cycles", 1))
+        self.seconds = float(settings.get("seconds", 0))
+
+    @property
+    def enabled(self) -> bool:
+        return self.cycles > 1 or self.seconds > 0
+
+    def load(self) -> None:
+        """ pending transitions are `direction:cycle:epoch`, and `_cycle` """
+        self.pending = {}
+        for entity, value in self.parent.redis.hgetall(self.key).items():
+            if entity == "_cycle":
+                self.cycle = int(value)
+                continue
+            direction, cycle, epoch = value.split(":")
+            self.pending[entity] = (int(direction), int(cycle), float(epoch))
+
+    def save(self) -> None:
+        def ops(pipe):
+            pipe.delete(self.key)
+            pipe.hset(self.key, mapping=dict(
+                {entity: "%d:%d:%f" % p for entity, p in self.pending.items()},
+                _cycle=self.cycle,
+            ))
+            pipe.expire(self.key, 60 * 60 * 24 * 7)
+        self.parent.fenced_write(ops)
+
+    def filter(self, onlined: list, offlined: list, now: float = None) -> tuple:
+        """ Take this cycle's transitions, return (onlined, offlined) that have lasted long enough """
+        self.first_seen = {}
+        if not self.enabled:
+            return onlined, offlined
+        now = time.time() if now is None else now
+        if self.pending is None:
+            self.load()
+        self.cycle += 1
+        flapped = 0
+        for direction, entities in ((1, onlined), (-1, offlined)):
+            for entity in entities:
+                p = self.pending.get(entity)
+                if p is not None and p[0] == -direction:
+                    del self.pending[entity]  # reverted, nothing has happened
+                    flapped += 1
+                else:
+                    self.pending[entity] = (direction, self.cycle, now)
+
+        onlined_emit, offlined_emit = [], []
+        for entity, (direction, cycle, epoch) in list(self.pending.items()):
+            if self.cycle - cycle + 1 >= self.cycles and now - epoch >= self.seconds:
+                (onlined_emit if direction > 0 else offlined_emit).append(entity)
+                self.first_seen[entity] = epoch
+                del self.pending[entity]
+        self.save()
+
+        self.parent.function_counter(f"debounce.{self.kind}.flapped", flapped)
+        self.parent.function_gauge(f"debounce.{self.kind}.pending", len(self.pending))
+        if flapped:
+            logging.debug("(Debounce) %d %s flapped, %d pending", flapped, self.kind, len(self.pending))
+        return onlined_emit, offlined_emit
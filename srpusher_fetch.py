@@ -0,0 +1,107 @@
+#! venv/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 sts=4 ff=unix ft=python expandtab
+
+"""
+    Fetch policy of SR API: timeouts, exponential backoff with jitter and a circuit breaker.
+
+    closed    -- requests go out. after an error, the next request waits backoff_base_sec * 2^(errors - 1) (with jitter, up to backoff_max_sec)
+    open      -- after `breaker_failures` consecutive errors, no request goes out for `breaker_cooldown_sec`
+    half_open -- after the cooldown, one request is tried. success closes the breaker, an error opens it again
+
+    The state is kept in memory and in a redis hash, so run once mode (cron) and a new leader honour the backoff and the breaker.
+"""
+import time
+import random
+import logging
+
+
+class FetchPolicy(object):
+    """ When to fetch SR API, and how long to wait for it """
+    key_policy = "_sr_fetch_policy"
+    state = "closed"
+    failures = 0
+    next_attempt = 0
+    loaded = False
+
+    def __init__(self, parent=None) -> None:
+        self.parent = parent
+        settings = parent.settings.get("fetch") or {}
+        self.connect_timeout_sec = float(settings.get("connect_timeout_sec", 5))
+        self.read_timeout_sec = float(settings.get("read_timeout_sec", 20))
+        self.backoff_base_sec = float(settings.get("backoff_base_sec", 30))
+        self.backoff_max_sec = float(settings.get("backoff_max_sec", 900))
+        self.breaker_failures = int(settings.get("breaker_failures", 5))
+        self.breaker_cooldown_sec = float(settings.get("breaker_cooldown_sec", 600))
+
+    def load(self) -> None:
+        """ `state`, `failures` and `next_attempt` (epoch) """
+        self.loaded = True
+        values = self.parent.redis.hgetall(self.key_policy)
+        if values:
+            self.state = values.get("state", "closed")
+            self.failures = int(values.get("failures", 0))
+            self.next_attempt = float(values.get("next_attempt", 0))
+
+    def save(self) -> None:
+        """ the state lives as long as the backoff or the cooldown could last, and some """
+        if self.state == "closed" and not self.failures:
+            self.parent.redis.delete(self.key_policy)
+            return
+        pipe = self.parent.redis.pipeline(transaction=True)
+        pipe.hset(self.key_policy, mapping={"state": self.state, "failures": self.failures, "next_attempt": self.next_attempt})
+        pipe.expire(self.key_policy, int(max(self.backoff_max_sec, self.breaker_cooldown_sec)) + 60 * 60)
+        pipe.execute()
+
+    @property
+    def timeout(self) -> tuple:
+        """ (connect, read) for requests """
+        return (self.connect_timeout_sec, self.read_timeout_sec)
+
+    def allow(self, now: float = None) -> bool:
+        """ True if a request may go out now """
+        now = time.time() if now is None else now
+        if not self.loaded:
+            self.load()
+        if now < self.next_attempt:
+            return False
+        if self.state == "open":
+            self.state = "half_open"
+            self.save()
+            logging.info("(SR API) circuit breaker half-open, trying one request.")
+        return True
+
+    def delay(self, now: float = None) -> float:
+        """ seconds until a request may go out """
+        now = time.time() if now is None else now
+        if not self.loaded:
+            self.load()
+        return max(0, self.next_attempt - now)
+
+    def success(self) -> None:
+        if not self.loaded:
+            self.load()
+        if self.state == "closed" and not self.failures:
+            return
+        if self.state != "closed":
+            logging.info("(SR API) recovered, circuit breaker closed.")
+        self.state = "closed"
+        self.failures = 0
+        self.next_attempt = 0
+        self.save()
+
+    def failure(self, now: float = None) -> None:
+        now = time.time() if now is None else now
+        if not self.loaded:
+            self.load()
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.breaker_failures:
+            if self.state != "open":
+                logging.warning("(SR API) %d errors, circuit breaker open for %s sec.", self.failures, self.breaker_cooldown_sec)
+            self.state = "open"
+            self.next_attempt = now + self.breaker_cooldown_sec
+        else:
+            backoff = min(self.backoff_max_sec, self.backoff_base_sec * 2 ** (self.failures - 1))
+            self.next_attempt = now + backoff / 2 + random.uniform(0, backoff / 2)
+        self.save()
+        self.parent.function_gauge("sr_status.fetch_failures", self.failures)
@@ -0,0 +1,207 @@
+#! venv/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 sts=4 ff=unix ft=python expandtab
+
+"""
+    How late the notifications are, as rolling percentiles.
+
+    detect_room  -- createTime of an onlined room to its detection
+    detect_user  -- the last poll a pinned target user was absent, to the detection of the user (after debouncing)
+    deliver      -- the same origin (createTime of a new room, or else the origin of detect_user of a target in the room) to a successful notification
+
+    A sketch is a histogram of logarithmic buckets (relative error `lag: relative_accuracy`), lags under a second count as a second.
+    __lag__<metric>:YYYYMMDDHH   hash of an hour (UTC): bucket -> count
+    Percentiles are over the last `lag: window_hours` hours, reported as gauges lag.<metric>.p50/p90/p99 every cycle.
+    Past hours are kept in memory, only the current hour is read again.
+"""
+import math
+import time
+import logging
+import collections
+from srpusher_time import parse_createtime
+
+
+class LagSketch(object):
+    """ Counts of buckets (gamma^(i-1), gamma^i], sketches are merged by adding counts """
+
+    def __init__(self, relative_accuracy: float = 0.02) -> None:
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.counts = collections.Counter()
+
+    def bucket(self, value: float) -> int:
+        return math.ceil(math.log(max(value, 1.0)) / self.log_gamma)
+
+    def value(self, bucket: int) -> float:
+        """ the middle of the bucket, within relative_accuracy of any value in it """
+        return 2 * self.gamma ** bucket / (self.gamma + 1)
+
+    def add(self, value: float, count: int = 1) -> None:
+        self.counts[self.bucket(value)] += count
+
+    def merge(self, counts: dict) -> None:
+        for bucket, count in counts.items():
+            self.counts[int(bucket)] += int(count)
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts.values())
+
+    def percentile(self, q: float) -> float:
+        """ q: 0-100, None if empty """
+        total = self.count
+        if not total:
+            return None
+        rank = q / 100 * (total - 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen > rank:
+                return self.value(bucket)
+        return self.value(max(self.counts))
+
+
+class LagTracker(object):
+    """ Samples of a cycle are added to the sketch of the hour in redis, in one pipeline """
+    header_lag = "__lag__"
+    key_last_poll = "_sr_lag_last_poll"
+    metrics = ("detect_room", "detect_user", "deliver")
+    percentiles = (50, 90, 99)
+    last_poll = None  # epoch of the previous poll
+    poll = None  # epoch of this poll
+
+    def __init__(self, parent=None) -> None:
+        self.parent = parent
+        settings = parent.settings.get("lag") or {}
+        self.window_hours = int(settings.get("window_hours", 24))
+        self.relative_accuracy = float(settings.get("relative_accuracy", 0.02))
+        self.slo_sec = float(settings["slo_sec"]) if settings.get("slo_sec") else None
+        self.slo_percentile = float(settings.get("slo_percentile", 90))
+        self.sketches = {}  # metric -> LagSketch of the window, as of the last report()
+        self.hours = {}  # (metric, hour) -> bucket counts read from redis, of the hours in the window
+        self.hour = None  # hour of the last report()
+        self.samples = []  # (metric, lag) not written yet
+        self.origins = {}  # roomid -> epoch the notification of the room is counted from
+        self.user_origins = {}  # userid (lower) -> epoch detect_user of the last detected() is counted from
+
+    def key(self, metric: str, hour: str) -> str:
+        return f"{self.header_lag}{metric}:{hour}"
+
+    def detected(self, onlined_rooms: list, onlined_users: list, now: float = None, first_seen: dict = None) -> None:
+        """ after the diff of a cycle: lags of onlined rooms, and of onlined target users.
+            first_seen: userid -> epoch the user was first seen, if held back by debouncing (Debouncer.first_seen)
+        """
+        now = time.time() if now is None else now
+        self.user_origins = {}
+        if self.last_poll is None:
+            try:
+                self.last_poll = float(self.parent.redis.get(self.key_last_poll))
+            except (TypeError, ValueError):
+                pass
+        self.poll = now
+        if self.last_poll is None:
+            return  # the first poll, everything was there before
+        for roomid in onlined_rooms:
+            room = self.parent.current_rooms.get(roomid)
+            if room is None:
+                continue
+            try:
+                self.samples.append(("detect_room", now - parse_createtime(room.get("createTime")).timestamp()))
+            except (TypeError, ValueError):
+                pass
+        targets = {t.lower() for t in self.parent.settings["sr"].get("targets") or []}
+        first_seen = first_seen or {}
+        for userid in onlined_users:
+            if userid.lower() in targets:
+                # one interval until first seen (as of now), and the time held back since then
+                origin = self.user_origins[userid.lower()] = self.last_poll - (now - first_seen.get(userid, now))
+                self.samples.append(("detect_user", now - origin))
+
+    def notifying(self, roomids: list, onlined_rooms: list) -> None:
+        """ origins of notifications about to be sent: createTime of a new room,
+            or else the earliest origin of the target users detected in the room (as detect_user), or the last poll
+        """
+        onlined_rooms = set(onlined_rooms)
+        self.origins = {}
+        if self.last_poll is None:
+            return
+        for roomid in roomids:
+            room = self.parent.current_rooms.get(roomid) or {}
+            try:
+                if roomid in onlined_rooms:
+                    self.origins[roomid] = parse_createtime(room.get("createTime")).timestamp()
+                    continue
+            except (TypeError, ValueError):
+                pass
+            userids = [m["userId"].lower() for m in room.get("members") or [] if m.get("userId")]
+            self.origins[roomid] = min([self.user_origins[u] for u in userids if u in self.user_origins], default=self.last_poll)
+
+    def delivered(self, roomid: str, now: float = None) -> None:
+        """ a notification has been sent, written at once (run once mode exits after sending) """
+        origin = self.origins.pop(roomid, None)
+        if origin is None:
+            return
+        now = time.time() if now is None else now
+        self.samples.append(("deliver", now - origin))
+        self.flush(now)
+
+    def flush(self, now: float = None) -> None:
+        now = time.time() if now is None else now
+        hour = time.strftime("%Y%m%d%H", time.gmtime(now))
+        samples, self.samples = self.samples, []
+        sketches = {}
+        for metric, lag in samples:
+            sketches.setdefault(metric, LagSketch(self.relative_accuracy)).add(lag)
+        pipe = self.parent.redis.pipeline(transaction=False)
+        for metric, sketch in sketches.items():
+            key = self.key(metric, hour)
+            for bucket, count in sketch.counts.items():
+                pipe.hincrby(key, bucket, count)
+            pipe.expire(key, (self.window_hours + 1) * 60 * 60)
+        pipe.execute()
+
+    def report(self, now: float = None) -> dict:
+        """ end of a cycle: write the samples and the poll time, read the sketches of the window, set gauges """
+        now = time.time() if now is None else now
+        self.flush(now)
+        if self.poll is not None:
+            self.parent.redis.set(self.key_last_poll, self.poll, ex=7 * 24 * 60 * 60)
+            self.last_poll = self.poll
+
+        hours = [time.strftime("%Y%m%d%H", time.gmtime(now - h * 60 * 60)) for h in range(self.window_hours)]
+        # the current hour, the hour of the last report (samples may have been added until it ended), and the hours not read yet
+        reads = [(metric, hour) for metric in self.metrics for hour in hours if (metric, hour) not in self.hours or hour >= (self.hour or hour)]
+        pipe = self.parent.redis.pipeline(transaction=False)
+        for metric, hour in reads:
+            pipe.hgetall(self.key(metric, hour))
+        self.hours = {k: v for k, v in self.hours.items() if k[1] in hours}
+        self.hours.update(zip(reads, pipe.execute()))
+        self.hour = hours[0]
+        gauges = {}
+        for metric in self.metrics:
+            sketch = self.sketches[metric] = LagSketch(self.relative_accuracy)
+            for hour in hours:
+                sketch.merge(self.hours[(metric, hour)])
+            gauges[f"lag.{metric}.count"] = sketch.count
+            for q in self.percentiles:
+                if sketch.count:
+                    gauges[f"lag.{metric}.p{q}"] = round(sketch.percentile(q), 1)
+        self.parent.redis.hset(self.parent.key_func_gauge, mapping=gauges)
+        logging.debug("(Lag) %s", gauges)
+        return gauges
+
+    def percentile(self, metric: str, q: float) -> float:
+        """ from the last report(), None if no samples """
+        sketch = self.sketches.get(metric)
+        return sketch.percentile(q) if sketch is not None else None
+
+    def cap_wait_sec(self, wait_sec: float, min_wait_sec: float = 0) -> float:
+        """ `lag: slo_sec`: while the lag of target users at `slo_percentile` is over it, shorten the interval in proportion """
+        if self.slo_sec is None:
+            return wait_sec
+        lag = self.percentile("detect_user", self.slo_percentile)
+        if lag is None or lag <= self.slo_sec:
+            return wait_sec
+        capped = max(min_wait_sec, wait_sec * self.slo_sec / lag)
+        logging.debug("(Lag) p%g %.0f sec > slo %.0f sec, wait_sec %.0f -> %.0f", self.slo_percentile, lag, self.slo_sec, wait_sec, capped)
+        return capped
@@ -0,0 +1,143 @@
+#! venv/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 sts=4 ff=unix ft=python expandtab
+
+"""
+    Archive events to SQLite for analysis.
+    Events are buffered in memory and written in batches (one transaction, executemany), WAL mode.
+    Enabled with `archive:` in settings.yml.
+
+    table events(epoch REAL, event TEXT, roomid TEXT, userid TEXT, name TEXT, payload TEXT(json))
+"""
+import json
+import time
+import atexit
+import logging
+import sqlite3
+import threading
+import traceback
+import pluggy
+
+srphookimpl = pluggy.HookimplMarker("srpusher")
+
+
+class SRPusher_Archive(object):
+    """
+    Archive onlined/offlined rooms and users, keyword hits and user changes to SQLite, in batches.
+    settings.yml: `archive: {use, path, batch_size, flush_interval_sec, max_buffer}`
+    """
+    db = None
+    retry_after = 0  # epoch, after a write error the batch is retried on the interval only
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        settings = (parent.settings.get("archive") or {}) if parent is not None else {}
+        if settings.get("use") is not True:
+            return
+        self.path = settings.get("path", "archive.sqlite3")
+        self.batch_size = int(settings.get("batch_size", 500))
+        self.flush_interval_sec = float(settings.get("flush_interval_sec", 60))
+        self.max_buffer = int(settings.get("max_buffer", self.batch_size * 10))
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS events (epoch REAL, event TEXT, roomid TEXT, userid TEXT, name TEXT, payload TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_epoch ON events (epoch)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_userid ON events (userid)")
+        self.db.commit()
+        atexit.register(self.close)
+        logging.info("(Archive) archiving events to %s", self.path)
+
+    def append(self, event: str, roomid: str, userid: str, name: str, payload: object) -> None:
+        """ Buffer an event, flush if the batch is full or the interval has passed """
+        if self.db is None:
+            return
+        try:
+            with self.lock:
+                self.buffer.append((time.time(), event, roomid, (userid or "").lower() or None, name, json.dumps(payload, ensure_ascii=False, separators=(",", ":"))))
+            self.flush(force=False)
+        except Exception:
+            logging.error(traceback.format_exc())
+
+    def flush(self, force=True) -> int:
+        """ Write buffered events in one transaction, returns the number of events """
+        if self.db is None:
+            return 0
+        with self.lock:
+            if not self.buffer or (not force and len(self.buffer) < self.batch_size and time.time() - self.last_flush < self.flush_interval_sec):
+                return 0
+            if not force and time.time() < self.retry_after:
+                return 0
+            rows, self.buffer = self.buffer, []
+            t = time.time()
+            try:
+                with self.db:
+                    self.db.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)", rows)
+            except sqlite3.Error:
+                # kept for the next flush (the transaction has been rolled back), up to `max_buffer` events
+                self.buffer[:0] = rows
+                self.last_flush = time.time()
+                self.retry_after = self.last_flush + self.flush_interval_sec  # not on every event of the poll loop
+                dropped = max(0, len(self.buffer) - self.max_buffer)
+                del self.buffer[:dropped]
+                if self.parent is not None:
+                    self.parent.function_counter("archive.errors")
+                    if dropped:
+                        self.parent.function_counter("archive.dropped", dropped)
+                raise
+            delta = time.time() - t
+            self.last_flush = time.time()
+        logging.debug("(Archive) %d events in %.1f ms (%.0f events/sec)", len(rows), delta * 1000, len(rows) / delta if delta else 0)
+        if self.parent is not None:
+            self.parent.function_counter("archive.events", len(rows))
+            self.parent.function_gauge("archive.events_per_sec", len(rows) / delta if delta else 0)
+        return len(rows)
+
+    def close(self) -> None:
+        if self.db is not None:
+            try:
+                self.flush()
+                self.db.close()
+            except Exception:
+                logging.error(traceback.format_exc())
+            self.db = None
+
+    @srphookimpl
+    def onlined_room(self, room: dict, roomid: str) -> None:
+        self.append("onlined_room", roomid, (room.get("creator") or {}).get("userId"), room.get("roomName"), room)
+
+    @srphookimpl
+    def offlined_room(self, room: dict, roomid: str) -> None:
+        self.append("offlined_room", roomid, (room.get("creator") or {}).get("userId"), room.get("roomName"), room)
+
+    @srphookimpl
+    def option_room(self, room: dict, roomid: str) -> None:
+        self.append("option_room", roomid, (room.get("creator") or {}).get("userId"), room.get("roomName"), room)
+
+    @srphookimpl
+    def onlined_user(self, user: dict, room: dict, roomid: str) -> None:
+        self.append("onlined_user", roomid, user.get("userId"), user.get("nickname"), user)
+
+    @srphookimpl
+    def offlined_user(self, user: dict, room: dict, roomid: str) -> None:
+        self.append("offlined_user", roomid, user.get("userId"), user.get("nickname"), user)
+
+    @srphookimpl
+    def hit_keyword(self, messages: list, keyword: None) -> None:
+        for message in messages:
+            self.append("hit_keyword", None, None, message, {"message": message, "keyword": keyword})
+
+    @srphookimpl
+    def change_user_status(self, user: dict, user_prev: dict, room: dict) -> None:
+        self.append("change_user_status", user.get("roomid"), user.get("userId"), user.get("nickname"), {"user": user, "user_prev": user_prev})
+
+    @srphookimpl
+    def py_function_count(self, counter: object, counter_prev: object) -> None:
+        """ once per cycle, flush if the interval has passed """
+        try:
+            self.flush(force=False)
+        except Exception:
+            logging.error(traceback.format_exc())
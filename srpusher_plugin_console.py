@@ -27,7 +27,7 @@ class SRPusher_Console(object):
     def onlined_room(self, room: dict, roomid: str) -> None:
         """ Called when a new room is created """
         try:
-            logging.info("Room has appeared: '{}' created by '{}'".format(room.get("roomName"), room["creator"].get("nickname")))
+            logging.info("Room has appeared: '%s' created by '%s'", room.get("roomName"), room["creator"].get("nickname"))
         except Exception:
             logging.error(traceback.format_exc())
 
@@ -35,7 +35,7 @@ class SRPusher_Console(object):
     def offlined_room(self, room: dict, roomid: str) -> None:
         """ Called when a room disappeared. The room object given is cached when it last existed. """
         try:
-            logging.info("Room has disappeared: '{}'".format(room.get("roomName")))
+            logging.info("Room has disappeared: '%s'", room.get("roomName"))
         except Exception:
             logging.error(traceback.format_exc())
 
@@ -43,7 +43,7 @@ class SRPusher_Console(object):
     def onlined_user(self, user: dict, room: dict, roomid: str) -> None:
         """ Called when a new user appears. """
         try:
-            logging.info("User Onlined: '{}' to room '{}'({}/5)".format(user.get("nickname"), room.get("roomName"), len(room.get("members"))))
+            logging.info("User Onlined: '%s' to room '%s'(%d/5)", user.get("nickname"), room.get("roomName"), len(room.get("members")))
         except Exception:
             logging.error(traceback.format_exc())
 
@@ -51,7 +51,7 @@ class SRPusher_Console(object):
     def offlined_user(self, user: dict, room: dict, roomid: str) -> None:
         """ Called when a user is no longer in any room (signed-out). The room and user objects given are cached they last existed. """
         try:
-            logging.info("User Offlined: '{}' from room '{}'({}/5)".format(user.get("nickname"), room.get("roomName"), len(room.get("members"))))
+            logging.info("User Offlined: '%s' from room '%s'(%d/5)", user.get("nickname"), room.get("roomName"), len(room.get("members")))
         except Exception:
             logging.error(traceback.format_exc())
 
@@ -59,7 +59,7 @@ class SRPusher_Console(object):
     def option_room(self, room: dict, roomid: str) -> None:
         """ room alternatives """
         try:
-            logging.info("(Option)Room: '{}'".format(room.get("roomName")))
+            logging.info("(Option)Room: '%s'", room.get("roomName"))
         except Exception:
             logging.error(traceback.format_exc())
 
@@ -68,20 +68,20 @@ class SRPusher_Console(object):
         """ keyword hit """
         try:
             for message in messages:
-                logging.info("(Hit Keyword) Message: {}".format(message))
+                logging.info("(Hit Keyword) Message: %s", message)
         except Exception:
             logging.error(traceback.format_exc())
 
     @srphookimpl
     def send_pushover(self, message: str, title: None) -> None:
         try:
-            logging.info(f"(Send PushOver) {title}: {message.strip()}")
+            logging.info("(Send PushOver) %s: %s", title, message.strip())
         except Exception:
             logging.error(traceback.format_exc())
 
     @srphookimpl
     def change_user_status(self, user: dict, user_prev: dict) -> None:
         try:
-            logging.debug("(userstatus) %s -> %s" % (str(user_prev), str(user)))
+            logging.debug("(userstatus) %s -> %s", user_prev, user)
         except Exception:
             logging.error(traceback.format_exc())
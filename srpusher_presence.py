@@ -0,0 +1,153 @@
+#! venv/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 sts=4 ff=unix ft=python expandtab
+
+"""
+    Presence history of users in redis bitmaps.
+    One bitmap per (interned) user per day (UTC), one bit per poll slot.
+    slot_sec=60: 1440 bits (180 bytes) per user per day.
+"""
+import time
+import datetime
+import logging
+
+
+class PresenceHistory(object):
+    """ Record who was online in every poll slot, and query it with BITCOUNT/BITPOS/BITOP """
+    header_presence = "__presence__"
+    key_last = "_sr_presence_last"
+
+    # KEYS: bitmaps newest first. returns {index of KEYS (1-based), bit offset} of the last set bit
+    _script_last_bit = """
+        for i, key in ipairs(KEYS) do
+            local s = redis.call('GET', key)
+            if s then
+                for b = #s, 1, -1 do
+                    local byte = string.byte(s, b)
+                    if byte ~= 0 then
+                        for bit = 0, 7 do
+                            if math.floor(byte / 2 ^ bit) % 2 == 1 then
+                                return {i, (b - 1) * 8 + (7 - bit)}
+                            end
+                        end
+                    end
+                end
+            end
+        end
+        return nil
+    """
+
+    def __init__(self, parent=None) -> None:
+        self.parent = parent
+        settings = parent.settings.get("presence") or {}
+        self.slot_sec = int(settings.get("slot_sec", 60))
+        if 86400 % self.slot_sec:
+            raise ValueError("presence: slot_sec must divide a day")
+        self.slots_per_day = 86400 // self.slot_sec
+        self.retention_sec = int(settings.get("retention_days", 90)) * 86400
+        # users online at both ends of a longer gap (e.g. the process was stopped) are not assumed online in between
+        self.max_fill_sec = float(settings.get("max_fill_sec", 600))
+        self.last_bit_script = parent.redis.register_script(self._script_last_bit)
+
+    def day(self, slot: int) -> str:
+        """ global slot number to day key """
+        return time.strftime("%Y%m%d", time.gmtime(slot * self.slot_sec))
+
+    def key(self, id: int, day: str) -> str:
+        return f"{self.header_presence}{id}:{day}"
+
+    def days(self, start: datetime.date, end: datetime.date) -> list:
+        """ day keys from start to end (inclusive) """
+        return [(start + datetime.timedelta(days=d)).strftime("%Y%m%d") for d in range((end - start).days + 1)]
+
+    def slot_time(self, day: str, offset: int) -> datetime.datetime:
+        return datetime.datetime.strptime(day, "%Y%m%d").replace(tzinfo=datetime.timezone.utc) + datetime.timedelta(seconds=offset * self.slot_sec)
+
+    def record(self, online_members: list, onlined_users: list, now: float = None) -> None:
+        """ record_ids() with userIds """
+        userids = list({u.lower() for u in online_members if u})
+        onlined = {u.lower() for u in onlined_users}
+        ids = self.parent.intern.intern(userids)
+        self.record_ids(ids, {id for userid, id in zip(userids, ids) if userid in onlined}, now=now)
+
+    def record_ids(self, online_ids: set, onlined_ids: set, now: float = None) -> None:
+        """ Set the bits of online users (interned ids) for the slots since the last record, in one (fenced) write.
+            Users online since the last record fill the slots in between, users onlined now get the current slot only.
+        """
+        self.parent.function_counter("presence.record")
+        now = time.time() if now is None else now
+        slot_now = int(now // self.slot_sec)
+        try:
+            last = float(self.parent.redis.get(self.key_last))
+        except (TypeError, ValueError):
+            last = None
+        if last is not None and 0 <= now - last <= self.max_fill_sec:
+            slots_continued = range(int(last // self.slot_sec) + 1, slot_now + 1)
+        else:
+            slots_continued = range(slot_now, slot_now + 1)
+
+        offsets = {}  # key -> [bit offset]
+        for id in online_ids:
+            for slot in (range(slot_now, slot_now + 1) if id in onlined_ids else slots_continued):
+                offsets.setdefault(self.key(id, self.day(slot)), []).append(slot % self.slots_per_day)
+
+        def ops(pipe):
+            for key, bits in offsets.items():
+                args = []
+                for bit in bits:
+                    args += ["SET", "u1", bit, 1]
+                pipe.execute_command("BITFIELD", key, *args)
+                pipe.expire(key, self.retention_sec)
+            pipe.set(self.key_last, now)
+        self.parent.fenced_write(ops)
+        self.parent.function_gauge("presence.record.keys", len(offsets))
+        logging.debug("(Presence) %d users, %d bitmaps", len(online_ids), len(offsets))
+
+    def _keys(self, userid: str, start: datetime.date, end: datetime.date) -> list:
+        id = self.parent.intern.lookup(userid.lower())
+        if id is None:
+            return []
+        return [(day, self.key(id, day)) for day in self.days(start, end)]
+
+    def online_seconds(self, userid: str, start: datetime.date, end: datetime.date) -> int:
+        """ Total seconds the user was online from start to end (inclusive) """
+        keys = self._keys(userid, start, end)
+        pipe = self.parent.redis.pipeline(transaction=False)
+        for _, key in keys:
+            pipe.bitcount(key)
+        return sum(pipe.execute()) * self.slot_sec if keys else 0
+
+    def first_seen(self, userid: str, start: datetime.date, end: datetime.date) -> datetime.datetime:
+        """ The first slot the user was online from start to end, or None """
+        keys = self._keys(userid, start, end)
+        pipe = self.parent.redis.pipeline(transaction=False)
+        for _, key in keys:
+            pipe.bitpos(key, 1)
+        for (day, _), offset in zip(keys, pipe.execute() if keys else []):
+            if offset >= 0:
+                return self.slot_time(day, offset)
+        return None
+
+    def last_seen(self, userid: str, start: datetime.date, end: datetime.date) -> datetime.datetime:
+        """ The last slot the user was online from start to end, or None """
+        keys = list(reversed(self._keys(userid, start, end)))
+        if not keys:
+            return None
+        found = self.last_bit_script(keys=[key for _, key in keys])
+        if not found:
+            return None
+        return self.slot_time(keys[int(found[0]) - 1][0], int(found[1]))
+
+    def overlap_seconds(self, userid1: str, userid2: str, start: datetime.date, end: datetime.date) -> int:
+        """ Seconds both users were online at the same time, from start to end """
+        keys1 = self._keys(userid1, start, end)
+        keys2 = self._keys(userid2, start, end)
+        if not keys1 or not keys2:
+            return 0
+        tmpkey = f"{self.header_presence}tmp:{userid1}:{userid2}"
+        pipe = self.parent.redis.pipeline(transaction=True)
+        for (_, key1), (_, key2) in zip(keys1, keys2):
+            pipe.bitop("AND", tmpkey, key1, key2)
+            pipe.bitcount(tmpkey)
+        pipe.delete(tmpkey)
+        return sum(pipe.execute()[1:-1:2]) * self.slot_sec
@@ -0,0 +1,167 @@
+#! venv/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 sts=4 ff=unix ft=python expandtab
+
+"""
+    Room lifecycle and occupancy aggregates, updated incrementally every cycle.
+
+    __roomstats__<roomid>           hash of a room: created, first_seen, last_seen, samples, members_sum, members_peak
+                                    (+ closed, lifetime_sec, members_avg when the room has gone)
+    __roomstats_hourly__YYYYMMDDHH  hash of an hour (UTC): samples, users_sum, users_peak, rooms_sum, rooms_peak, onlined_users, onlined_rooms
+    __roomstats_daily__YYYYMMDD     hash of a day (UTC) of the rooms gone: rooms_closed, lifetime_sec_sum, lifetime_sec_max, members_avg_sum, members_peak_max
+"""
+import time
+import logging
+from srpusher_time import parse_createtime
+
+
+class RoomAggregates(object):
+    """ Running counters in memory, flushed to redis as increments in one (fenced) write per cycle, read in O(1) """
+    header_room = "__roomstats__"
+    header_hourly = "__roomstats_hourly__"
+    header_daily = "__roomstats_daily__"
+    ttl_room = 60 * 60 * 24 * 7
+    ttl_hourly = 60 * 60 * 24 * 90
+    ttl_daily = 60 * 60 * 24 * 400
+    room_fields = ("created", "first_seen", "last_seen", "samples", "members_sum", "members_peak")
+    hourly_fields = ("samples", "users_sum", "users_peak", "rooms_sum", "rooms_peak", "onlined_users", "onlined_rooms")
+    daily_fields = ("rooms_closed", "lifetime_sec_sum", "lifetime_sec_max", "members_avg_sum", "members_peak_max")
+
+    def __init__(self, parent=None) -> None:
+        self.parent = parent
+        self.rooms = {}  # roomid -> {room_fields}
+        self.hour = None
+        self.hourly = None
+        self.day = None
+        self.daily = None
+
+    def load_rooms(self, roomids: list) -> None:
+        """ Read running counters of rooms not in memory (on startup, or run once mode) """
+        pipe = self.parent.redis.pipeline(transaction=False)
+        for roomid in roomids:
+            pipe.hgetall(self.header_room + roomid)
+        for roomid, values in zip(roomids, pipe.execute()):
+            if values and "closed" not in values:
+                self.rooms[roomid] = {k: float(values.get(k, 0)) for k in self.room_fields}
+
+    def reset(self) -> None:
+        """ Forget the counters in memory, they are read from redis again (a new leader term, another instance may have counted meanwhile) """
+        self.rooms = {}
+        self.hour = self.hourly = None
+        self.day = self.daily = None
+
+    def update(self, rooms: dict, onlined_users: list, onlined_rooms: list, offlined_rooms: list, now: float = None) -> None:
+        """ rooms: {roomid: room} alive in this cycle.
+            Sums are written as increments (HINCRBYFLOAT), peaks and times as values, in one fenced write.
+        """
+        now = time.time() if now is None else now
+        missing = [roomid for roomid in list(rooms) + list(offlined_rooms) if roomid not in self.rooms]
+        if missing:
+            self.load_rooms(missing)
+        # rooms gone without an offlined_room event (e.g. while this instance was standby) stay in redis only
+        for roomid in [roomid for roomid in self.rooms if roomid not in rooms and roomid not in offlined_rooms]:
+            del self.rooms[roomid]
+
+        users = set()
+        increments = {}  # roomid -> members of this cycle
+        for roomid, room in rooms.items():
+            members = room.get("members") or []
+            users.update(m["userId"].lower() for m in members if m.get("userId"))  # a user logged in twice counts once
+            r = self.rooms.get(roomid)
+            if r is None:
+                try:
+                    created = parse_createtime(room.get("createTime")).timestamp()
+                except (TypeError, ValueError):
+                    created = now
+                r = self.rooms[roomid] = {"created": created, "first_seen": now, "last_seen": now, "samples": 0, "members_sum": 0, "members_peak": 0}
+            r["last_seen"] = now
+            r["samples"] += 1
+            r["members_sum"] += len(members)
+            r["members_peak"] = max(r["members_peak"], len(members))
+            increments[roomid] = len(members)
+
+        hour = time.strftime("%Y%m%d%H", time.gmtime(now))
+        if hour != self.hour:
+            self.hour, self.hourly = hour, self.load(self.header_hourly + hour, self.hourly_fields)
+        hourly_increments = {"samples": 1, "users_sum": len(users), "rooms_sum": len(rooms), "onlined_users": len(onlined_users), "onlined_rooms": len(onlined_rooms)}
+        h = self.hourly
+        for k, v in hourly_increments.items():
+            h[k] += v
+        h["users_peak"] = max(h["users_peak"], len(users))
+        h["rooms_peak"] = max(h["rooms_peak"], len(rooms))
+
+        day = time.strftime("%Y%m%d", time.gmtime(now))
+        if offlined_rooms and day != self.day:
+            self.day, self.daily = day, self.load(self.header_daily + day, self.daily_fields)
+
+        def ops(pipe):
+            for roomid, members in increments.items():
+                key = self.header_room + roomid
+                r = self.rooms[roomid]
+                pipe.hset(key, mapping={k: r[k] for k in ("created", "first_seen", "last_seen", "members_peak")})
+                pipe.hincrbyfloat(key, "samples", 1)
+                pipe.hincrbyfloat(key, "members_sum", members)
+                pipe.expire(key, self.ttl_room)
+            key = self.header_hourly + hour
+            for k, v in hourly_increments.items():
+                pipe.hincrbyfloat(key, k, v)
+            pipe.hset(key, mapping={"users_peak": h["users_peak"], "rooms_peak": h["rooms_peak"]})
+            pipe.expire(key, self.ttl_hourly)
+            if offlined_rooms:
+                for roomid in offlined_rooms:
+                    self.finalize(pipe, roomid, now)
+                pipe.expire(self.header_daily + day, self.ttl_daily)
+        self.parent.fenced_write(ops)
+
+    def load(self, key: str, fields: tuple) -> dict:
+        values = self.parent.redis.hgetall(key)
+        return {k: float(values.get(k, 0)) for k in fields}
+
+    def finalize(self, pipe, roomid: str, now: float) -> None:
+        """ The room has gone: lifetime and average members, added to the daily aggregates """
+        r = self.rooms.pop(roomid, None)
+        if r is None or not r["samples"]:
+            return
+        lifetime_sec = r["last_seen"] - min(r["created"], r["first_seen"])
+        members_avg = r["members_sum"] / r["samples"]
+        key = self.header_room + roomid
+        pipe.hset(key, mapping={"closed": now, "lifetime_sec": lifetime_sec, "members_avg": members_avg})
+        pipe.expire(key, self.ttl_room)
+        d = self.daily
+        increments = {"rooms_closed": 1, "lifetime_sec_sum": lifetime_sec, "members_avg_sum": members_avg}
+        for k, v in increments.items():
+            d[k] += v
+            pipe.hincrbyfloat(self.header_daily + self.day, k, v)
+        d["lifetime_sec_max"] = max(d["lifetime_sec_max"], lifetime_sec)
+        d["members_peak_max"] = max(d["members_peak_max"], r["members_peak"])
+        pipe.hset(self.header_daily + self.day, mapping={"lifetime_sec_max": d["lifetime_sec_max"], "members_peak_max": d["members_peak_max"]})
+        logging.debug("(Stats) room %s closed, lifetime %d sec, members avg %.1f", roomid, lifetime_sec, members_avg)
+
+    def room_stats(self, roomid: str) -> dict:
+        """ lifetime (so far), members average and peak of a room, or {} """
+        values = {k: float(v) for k, v in self.parent.redis.hgetall(self.header_room + roomid).items()}
+        if not values:
+            return {}
+        values.setdefault("lifetime_sec", values["last_seen"] - min(values["created"], values["first_seen"]))
+        values.setdefault("members_avg", values["members_sum"] / values["samples"] if values["samples"] else 0)
+        return values
+
+    def hourly_stats(self, hour: str) -> dict:
+        """ hour: YYYYMMDDHH (UTC). averages and peaks of users and rooms, onlined users and rooms """
+        values = {k: float(v) for k, v in self.parent.redis.hgetall(self.header_hourly + hour).items()}
+        if not values:
+            return {}
+        samples = values.get("samples") or 1
+        values["users_avg"] = values.get("users_sum", 0) / samples
+        values["rooms_avg"] = values.get("rooms_sum", 0) / samples
+        return values
+
+    def daily_stats(self, day: str) -> dict:
+        """ day: YYYYMMDD (UTC). rooms gone on the day, their lifetime and members """
+        values = {k: float(v) for k, v in self.parent.redis.hgetall(self.header_daily + day).items()}
+        if not values:
+            return {}
+        closed = values.get("rooms_closed") or 1
+        values["lifetime_sec_avg"] = values.get("lifetime_sec_sum", 0) / closed
+        values["members_avg"] = values.get("members_avg_sum", 0) / closed
+        return values
@@ -0,0 +1,149 @@
+#! venv/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 sts=4 ff=unix ft=python expandtab
+
+"""
+    Event bus on a redis stream, for consumers in other processes or machines.
+
+    Publisher: enabled with `stream: use: True`, every event of a cycle is XADDed in one pipeline (capped by MAXLEN ~).
+    Each entry: {"event": name, "roomid": str, "userid": str, "epoch": float, "payload": json}
+
+    Consumer (in another process):
+
+        consumer = EventStreamConsumer(redis.Redis(decode_responses=True), group="archive", consumer="worker-1")
+        consumer.run(lambda event: print(event["event"], event["payload"]))
+"""
+import json
+import time
+import socket
+import logging
+import traceback
+import redis
+import pluggy
+
+srphookimpl = pluggy.HookimplMarker("srpusher")
+
+
+def encode_event(event: str, roomid: str, userid: str, payload: object) -> dict:
+    return {
+        "event": event,
+        "roomid": roomid or "",
+        "userid": (userid or "").lower(),
+        "epoch": time.time(),
+        "payload": json.dumps(payload, ensure_ascii=False, separators=(",", ":")),
+    }
+
+
+def decode_event(fields: dict) -> dict:
+    event = dict(fields)
+    event["epoch"] = float(event.get("epoch") or 0)
+    event["payload"] = json.loads(event.get("payload") or "null")
+    return event
+
+
+class EventStreamPublisher(object):
+    """ Registered to the plugin manager by SRPusher, buffers events of a cycle and publishes them in flush() """
+    default_key = "srpusher_events"
+
+    def __init__(self, parent=None) -> None:
+        self.parent = parent
+        settings = parent.settings.get("stream") or {}
+        self.key = settings.get("key", self.default_key)
+        self.maxlen = int(settings.get("maxlen", 100000))
+        self.buffer = []
+
+    def append(self, event: str, roomid: str, userid: str, payload: object) -> None:
+        try:
+            self.buffer.append(encode_event(event, roomid, userid, payload))
+        except Exception:
+            logging.error(traceback.format_exc())
+
+    def discard(self) -> int:
+        """ Drop buffered events without publishing, returns the number of events """
+        events, self.buffer = self.buffer, []
+        if events:
+            logging.debug("(Stream) discarded %d events of an aborted cycle", len(events))
+            self.parent.function_counter("stream.discarded", len(events))
+        return len(events)
+
+    def flush(self) -> int:
+        """ XADD all buffered events in one pipeline """
+        if not self.buffer:
+            return 0
+        events, self.buffer = self.buffer, []
+        pipe = self.parent.redis.pipeline(transaction=False)
+        for fields in events:
+            pipe.xadd(self.key, fields, maxlen=self.maxlen, approximate=True)
+        pipe.execute()
+        self.parent.function_counter("stream.published", len(events))
+        return len(events)
+
+    @srphookimpl
+    def onlined_room(self, room: dict, roomid: str) -> None:
+        self.append("onlined_room", roomid, None, room)
+
+    @srphookimpl
+    def offlined_room(self, room: dict, roomid: str) -> None:
+        self.append("offlined_room", roomid, None, room)
+
+    @srphookimpl
+    def option_room(self, room: dict, roomid: str) -> None:
+        self.append("option_room", roomid, None, room)
+
+    @srphookimpl
+    def onlined_user(self, user: dict, room: dict, roomid: str) -> None:
+        self.append("onlined_user", roomid, user.get("userId"), user)
+
+    @srphookimpl
+    def offlined_user(self, user: dict, room: dict, roomid: str) -> None:
+        self.append("offlined_user", roomid, user.get("userId"), user)
+
+    @srphookimpl
+    def hit_keyword(self, messages: list, keyword: None) -> None:
+        self.append("hit_keyword", None, None, {"messages": messages, "keyword": keyword})
+
+    @srphookimpl
+    def change_user_status(self, user: dict, user_prev: dict, room: dict) -> None:
+        self.append("change_user_status", user.get("roomid"), user.get("userId"), {"user": user, "user_prev": user_prev})
+
+
+class EventStreamConsumer(object):
+    """ A consumer of a consumer group. Consumers of the same group share the events, each event goes to one of them. """
+
+    def __init__(self, redis_client, group: str, consumer: str = None, key: str = EventStreamPublisher.default_key) -> None:
+        """ redis_client: redis.Redis with decode_responses=True """
+        self.redis = redis_client
+        self.key = key
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{id(self)}"
+        try:
+            self.redis.xgroup_create(self.key, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self, count: int = 100, block_ms: int = 5000) -> list:
+        """ New events for this consumer, [(id, event)]. they must be ack()ed after processing """
+        result = self.redis.xreadgroup(self.group, self.consumer, {self.key: ">"}, count=count, block=block_ms)
+        return [(id, decode_event(fields)) for _, entries in result or [] for id, fields in entries]
+
+    def ack(self, ids: list) -> int:
+        if not ids:
+            return 0
+        return self.redis.xack(self.key, self.group, *ids)
+
+    def claim(self, min_idle_ms: int = 60000, count: int = 100) -> list:
+        """ Take over events which other (dead) consumers have read but not acked for min_idle_ms """
+        result = self.redis.xautoclaim(self.key, self.group, self.consumer, min_idle_ms, start_id="0-0", count=count)
+        return [(id, decode_event(fields)) for id, fields in result[1] if fields]
+
+    def run(self, handler, count: int = 100, block_ms: int = 5000, min_idle_ms: int = 60000) -> None:
+        """ Call handler(event) for every event and ack it. Events whose handler raised are left pending, and claimed again later """
+        while True:
+            for id, event in self.claim(min_idle_ms, count) + self.read(count, block_ms):
+                try:
+                    handler(event)
+                except Exception:
+                    logging.error(traceback.format_exc())
+                    continue
+                self.ack([id])
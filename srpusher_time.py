@@ -0,0 +1,17 @@
+#! venv/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 sts=4 ff=unix ft=python expandtab
+
+"""
+    Time values of SR API, shared by srpusher and its helper modules.
+"""
+import datetime
+
+
+def parse_createtime(value: str) -> datetime.datetime:
+    """ Parse `createTime` of API like '2023-11-12 14:36:11 GMT', falls back to dateutil (imported lazily) """
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S GMT").replace(tzinfo=datetime.timezone.utc)
+    except (TypeError, ValueError):
+        import dateutil.parser
+        return dateutil.parser.parse(value)
@@ -5,13 +5,43 @@
 import unittest
 import json
 import datetime
+import time
 import dateutil.parser
 import base64
+import urllib.request
+import copy
+import os
+import sys
+import sqlite3
+import tempfile
+import io
+import logging
+import logging.handlers
+import queue
+import asyncio
+import unittest.mock
+import pluggy
+import redis
 
+import srpusher_async
+from srpusher_presence import PresenceHistory
+from srpusher_api import Snapshot, QueryAPI
+from srpusher_fetch import FetchPolicy
+from srpusher_plugin_archive import SRPusher_Archive
+from srpusher_debounce import Debouncer
+from srpusher_stream import EventStreamPublisher, EventStreamConsumer
+from srpusher_stats import RoomAggregates
+from srpusher_cache import LocalCache
+from srpusher_lag import LagSketch, LagTracker
+from run_srpusher import JsonLinesFormatter, LazyQueueHandler, plugins_cache_key, plugins_cache_filename
 from srpusher import (
+        parse_createtime,
         Config,
         SRPusher,
+        LeaderLease,
+        LeaseLostError,
 )
+srphookimpl = pluggy.HookimplMarker("srpusher")
 
 class TestConfig(unittest.TestCase):
     def setUp(self):
@@ -21,6 +51,31 @@ class TestConfig(unittest.TestCase):
     def test_config_defaults(self):
         self.assertTrue(self.config.settings["global"]["test"])
 
+    def test_config_cache(self):
+        """ parsed settings are cached """
+        settings = self.config.settings
+        config = Config()
+        config._filename = "settings_test.yml"
+        self.assertEqual(config.load_settings_cache(), settings)
+
+    def test_config_cache_mode(self):
+        """ the cache of a private config file is private too """
+        with tempfile.TemporaryDirectory() as d:
+            config = Config()
+            config._filename = os.path.join(d, "settings.yml")
+            with open(config._filename, "w") as fp:
+                fp.write("pushover:\n  user_key: secret\n")
+            os.chmod(config._filename, 0o600)
+            self.assertEqual(config.settings["pushover"]["user_key"], "secret")
+            self.assertEqual(os.stat(config.settings_cache_filename).st_mode & 0o777, 0o600)
+            self.assertEqual(sorted(os.listdir(d)), ["settings.yml", "settings.yml.cache"])  # no temporary file left
+
+    def test_plugins_cache_key(self):
+        """ files written next to the plugin manifest (caches, databases) do not outdate it """
+        key = plugins_cache_key()
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(plugins_cache_filename), suffix=".cache"):
+            self.assertEqual(plugins_cache_key(), key)
+
 
 class TestSRPusher(unittest.TestCase):
     testapidata="""
@@ -119,8 +174,6 @@ eyJyb29tcyI6IFt7InJlYWxtIjogNCwgImluZGV4IjogMSwgInJvb21BdHRyaWJ1dGUiOiB7Imxhbmd1
         self.assertIs(type(self.s.sr_status["rooms"][0]["creator"]["nsgmMemberId"]), str)
 
     def reload_test_users_list(self) -> list:
-        self.key_members_previous= "_test" + self.s.key_members_previous
-        self.key_members = "_test" + self.s.key_members
         members = []
         members.append(self._sr_status["rooms"][0]["members"][0]["userId"])
         members.append(self._sr_status["rooms"][0]["members"][1]["userId"])
@@ -130,56 +183,149 @@ eyJyb29tcyI6IFt7InJlYWxtIjogNCwgImluZGV4IjogMSwgInJvb21BdHRyaWJ1dGUiOiB7Imxhbmd1
         members.append(self._sr_status["rooms"][1]["members"][2]["userId"])
         members.append(self._sr_status["rooms"][1]["members"][3]["userId"])
         members.append(self._sr_status["rooms"][1]["members"][4]["userId"])
-        self.s.set_users_status(self.key_members_previous, members)
-        self.s.set_users_status(self.key_members, members)
+        self.s.redis.delete(self.s.key_members_ids)
+        self.s._online_ids = None
+        self.s.diff_online_ids(self.online_ids(members))
         return members
 
+    def online_ids(self, userids: list) -> set:
+        return set(self.s.intern.intern([userid.lower() for userid in userids]))
+
     def test_users_status_diff(self):
         """ no diff users list """
-        self.reload_test_users_list()
-        diff = self.s.get_users_diff(self.key_members_previous, self.key_members)
-        self.assertEqual(len(diff), 0)
-        diff = self.s.get_users_diff(self.key_members, self.key_members_previous)
-        self.assertEqual(len(diff), 0)
+        members = self.reload_test_users_list()
+        onlined, offlined = self.s.diff_online_ids(self.online_ids(members))
+        self.assertEqual((len(onlined), len(offlined)), (0, 0))
 
     def test_users_status_offlined(self):
         """ offlined users """
         user = "c9253f7e-6a84-4ceb-b1a8-f339e9a5b823"
-        self.reload_test_users_list()
+        members = self.reload_test_users_list()
         # remove a user
-        self.s.redis.srem(self.key_members, user)
+        onlined, offlined = self.s.diff_online_ids(self.online_ids(members) - self.online_ids([user]))
         # the user is in offlined-list
-        diff = self.s.get_users_diff(self.key_members_previous, self.key_members)
-        self.assertTrue(user in diff)
+        self.assertEqual(self.s.intern.userids_of(list(offlined)), [user])
         # onlined is 0
-        diff = self.s.get_users_diff(self.key_members, self.key_members_previous)
-        self.assertEqual(len(diff), 0)
+        self.assertEqual(len(onlined), 0)
 
     def test_users_status_onlined(self):
         """ onlined users """
         user = "0efffd95-7ce1-4d37-9a96-24406d0f70b4"
-        self.reload_test_users_list()
+        members = self.reload_test_users_list()
         # add a user
-        self.s.redis.sadd(self.key_members, user)
+        onlined, offlined = self.s.diff_online_ids(self.online_ids(members + [user]))
         # offlined is 0
-        diff = self.s.get_users_diff(self.key_members_previous, self.key_members)
-        self.assertEqual(len(diff), 0)
+        self.assertEqual(len(offlined), 0)
         # the user is in onlined-list
-        diff = self.s.get_users_diff(self.key_members, self.key_members_previous)
-        self.assertTrue(user in diff)
+        self.assertEqual(self.s.intern.userids_of(list(onlined)), [user])
+
+    def test_map_member_room(self):
+        """ the members without userId (the bot) count as one, as before interning """
+        self.s.map_member_room(copy.deepcopy(self._sr_status))
+        self.assertEqual(len(self.s._all_members), 9)
 
     def test_users_status_flush(self):
-        """ replace previous user's list """
+        """ previous user's list is carried over to the next process """
         members = self.reload_test_users_list()
-        self.s.flush_users_status(self.key_members, self.key_members_previous)
-        diff = self.s.get_users_diff(self.key_members, self.key_members_previous)
-        self.assertEqual(len(diff), 0)  # no `key_members`
-        diff = self.s.get_users_diff(self.key_members_previous, self.key_members)
-        self.assertEqual(len(diff), len(members))
+        self.s._online_ids = None
+        self.assertEqual(self.s.load_online_ids(), self.online_ids(members))
 
     def test_check_user_diff(self):
         members = self.reload_test_users_list()
 
+    def test_user_digest(self):
+        """ digest changes only with nickname, icon or room """
+        user = dict(self._sr_status["rooms"][0]["members"][0], roomid="r1")
+        digest = self.s.user_digest(user)
+        self.assertEqual(self.s.user_digest(dict(user, online=False, favorite=True)), digest)
+        self.assertNotEqual(self.s.user_digest(dict(user, nickname="x")), digest)
+        self.assertNotEqual(self.s.user_digest(dict(user, iconInfo={})), digest)
+        self.assertNotEqual(self.s.user_digest(dict(user, roomid="r2")), digest)
+        self.assertNotEqual(self.s.user_digest({k: v for k, v in user.items() if k != "iconInfo"}), digest)
+
+    def test_change_user_status(self):
+        """ change_user_status is called only for changed users """
+        class Recorder(object):
+            changed = []
+
+            @pluggy.HookimplMarker("srpusher")
+            def change_user_status(self, user, user_prev, room):
+                self.changed.append(user["userId"])
+
+        pm = pluggy.PluginManager("srpusher")
+        s = SRPusher(configfilename="settings_test.yml", dry_run=True, pm=pm)
+        pm.add_hookspecs(SRPusher)
+        recorder = Recorder()
+        pm.register(recorder)
+        s.redis.delete(s.key_user_digest, s.key_members_ids)
+        content = copy.deepcopy(self._sr_status)
+        s.check_sr_status_diff(content)
+        s.redis.expire(s.key_user_digest, 60)
+        digested = float(s.redis.hget(s.key_func_count, "check_user_diff.digest"))
+        s.check_sr_status_diff(copy.deepcopy(self._sr_status))
+        self.assertEqual(recorder.changed, [])
+        # unchanged users are not written again, the expiry is still refreshed
+        self.assertEqual(float(s.redis.hget(s.key_func_count, "check_user_diff.digest")), digested)
+        self.assertGreater(s.redis.ttl(s.key_user_digest), 60)
+        content = copy.deepcopy(self._sr_status)
+        content["rooms"][1]["members"][2]["nickname"] = "renamed"
+        del content["rooms"][0]["members"][1]["iconInfo"]
+        s.check_sr_status_diff(content)
+        self.assertEqual(recorder.changed, ["4ee70da2-655f-4af9-a08e-c203dd37fea2", "5e00a3ac-376d-4bdc-bcff-eef38d24e025"])
+
+        # digests of offlined users are removed
+        del content["rooms"][0]
+        s.check_sr_status_diff(content)
+        self.assertEqual(s.redis.hlen(s.key_user_digest), 5)
+        self.assertIsNone(s.redis.hget(s.key_user_digest, "4ee70da2-655f-4af9-a08e-c203dd37fea2"))
+
+    def test_online_ids(self):
+        """ onlined/offlined users on interned ids, carried over to a new process (run once mode) """
+        def instance():
+            pm = pluggy.PluginManager("srpusher")
+            s = SRPusher(configfilename="settings_test.yml", dry_run=True, pm=pm)
+            pm.add_hookspecs(SRPusher)
+            return s
+        s = instance()
+        s.redis.delete(s.key_members_ids, s.key_members, s.key_members_previous)
+        s.redis.sadd(s.key_members_previous, "7939de86-6c83-49da-9ed1-08580d76bdf3")  # written by an older version
+        onlined, offlined = s.check_sr_status_diff(copy.deepcopy(self._sr_status))[:2]
+        self.assertEqual(len(onlined), 7)
+        self.assertEqual(offlined, [])
+        self.assertEqual(s.intern.userids_of(list(next(iter(s.room_members.values())))), ["7939de86-6c83-49da-9ed1-08580d76bdf3", "4ee70da2-655f-4af9-a08e-c203dd37fea2", "ba9fddcb-9abc-4928-b417-1becb5804862"])
+        self.assertFalse(s.redis.exists(s.key_members_previous))
+
+        content = copy.deepcopy(self._sr_status)
+        del content["rooms"][0]
+        s = instance()
+        onlined, offlined = s.check_sr_status_diff(content)[:2]
+        self.assertEqual(onlined, [])
+        self.assertEqual(sorted(offlined), ["4ee70da2-655f-4af9-a08e-c203dd37fea2", "7939de86-6c83-49da-9ed1-08580d76bdf3", "ba9fddcb-9abc-4928-b417-1becb5804862"])
+        onlined, offlined = s.check_sr_status_diff(copy.deepcopy(self._sr_status))[:2]
+        self.assertEqual(len(onlined), 3)
+        self.assertEqual(s.redis.scard(s.key_members_ids), 8)
+
+    def test_hit_keyword_once(self):
+        """ hit_keyword is called once per room, however many members hit """
+        class Recorder(object):
+            def __init__(self):
+                self.hits = []
+
+            @srphookimpl
+            def hit_keyword(self, messages, keyword):
+                self.hits.append(messages)
+
+        pm = pluggy.PluginManager("srpusher")
+        s = SRPusher(configfilename="settings_test.yml", dry_run=True, pm=pm)
+        pm.add_hookspecs(SRPusher)
+        recorder = Recorder()
+        pm.register(recorder)
+        content = copy.deepcopy(self._sr_status)
+        for m in content["rooms"][1]["members"][:2]:
+            m["nickname"] = "TARGETKEYWORD_ONE " + m["userId"] + str(time.time())
+        s.check_sr_status_members(content, [])
+        self.assertEqual(recorder.hits, [["keyword: D/O/P/E Street Life"]])
+
     def test_wait_sec(self):
         user_count_changes_list = [20, 50, 70, 120, 200, 300, 500, 500, 500, 500, 500, 500, 500, 500, 500, 500, ]
         base_wait_sec = float(self.s.settings["sr"]["api_duration_sec"])
@@ -193,10 +339,631 @@ eyJyb29tcyI6IFt7InJlYWxtIjogNCwgImluZGV4IjogMSwgInJvb21BdHRyaWJ1dGUiOiB7Imxhbmd1
                 self.assertLess(wait_sec, 80)
             prev_wait_sec = wait_sec
 
+    def test_parse_createtime(self):
+        """ fast path and dateutil give the same time """
+        for room in self._sr_status["rooms"]:
+            self.assertEqual(parse_createtime(room["createTime"]), dateutil.parser.parse(room["createTime"]))
+        self.assertEqual(parse_createtime("2023-11-12T14:36:11Z"), dateutil.parser.parse("2023-11-12T14:36:11Z"))
+
+    def test_api_snapshot(self):
+        """ lookups and search on the snapshot """
+        rooms = {str(i): room for i, room in enumerate(self._sr_status["rooms"])}
+        snapshot = Snapshot(rooms)
+        self.assertEqual(snapshot.counts()["rooms"], 3)
+        self.assertEqual(snapshot.counts()["users"], 8)  # without the bot
+        self.assertEqual(snapshot.user_rooms["c9253f7e-6a84-4ceb-b1a8-f339e9a5b823"], ["1"])
+        self.assertEqual(snapshot.search("PERAL"), [("user", "5e00a3ac-376d-4bdc-bcff-eef38d24e025")])
+        self.assertEqual(snapshot.search("ro"), [("room", "2"), ("room", "0")])  # by name
+        self.assertEqual(snapshot.search("no such name"), [])
+        names = [snapshot.names[entry] for entry in snapshot.search("e")]
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(snapshot.search("e", limit=2), snapshot.search("e")[:2])
+
+    def test_api_unix_path(self):
+        """ only a stale socket is removed from the unix: path, not a regular file """
+        api = QueryAPI(parent=self.s)
+        with tempfile.NamedTemporaryFile() as fp:
+            api.bind = "unix:" + fp.name
+            with self.assertRaises(OSError):
+                api.start()
+            self.assertTrue(os.path.exists(fp.name))
+
+    def test_api_not_started(self):
+        """ the snapshot is not built while nothing serves it (run once mode) """
+        pm = pluggy.PluginManager("srpusher")
+        s = SRPusher(configfilename="settings_test.yml", dry_run=True, pm=pm)
+        pm.add_hookspecs(SRPusher)
+        s.api = QueryAPI(parent=s)
+        s.process_sr_status(copy.deepcopy(self._sr_status))
+        self.assertIsNone(s.api.snapshot)
+        for key in s.redis.keys(s.header_keyword + "*"):
+            s.redis.delete(key)  # notified keywords, for test_check_keyword
+
+    def test_api_http(self):
+        """ serve the snapshot """
+        api = QueryAPI(parent=self.s)
+        api.bind = "127.0.0.1:0"
+        api.update({"r1": self._sr_status["rooms"][0]})
+        api.start()
+        try:
+            url = "http://127.0.0.1:%d" % api.server.server_address[1]
+            with urllib.request.urlopen(url + "/users/7939DE86-6c83-49da-9ed1-08580d76bdf3") as response:
+                self.assertEqual(json.load(response)["rooms"], ["r1"])
+            with urllib.request.urlopen(url + "/search?q=julio") as response:
+                self.assertEqual(len(json.load(response)["users"]), 1)
+        finally:
+            api.stop()
+
     def test_lpf(self):
         a = self.s.lpf(5, 1, T=.1)
         self.assertLess(a, 5)
         self.assertGreater(a, 1)
 
+class TestAsyncEngine(unittest.TestCase):
+    def setUp(self):
+        self.pm = pluggy.PluginManager("srpusher")
+        self.s = SRPusher(configfilename="settings_test.yml", dry_run=True, pm=self.pm)
+        self.pm.add_hookspecs(SRPusher)
+        self.s.redis.delete(self.s.key_members_ids, self.s.key_rooms_previous, self.s.key_func_count, self.s.key_func_count_previous, self.s.key_func_gauge, FetchPolicy.key_policy)
+
+    def test_runonce(self):
+        """ a cycle on the async engine, with requests in threads """
+        response = unittest.mock.Mock(status_code=200, text=base64.b64decode(TestSRPusher.testapidata[1:-1]).decode('utf-8'))
+        with unittest.mock.patch.object(srpusher_async, "aiohttp", None), unittest.mock.patch("requests.get", return_value=response) as get:
+            asyncio.run(srpusher_async.AsyncEngine(parent=self.s).run(runonce=True))
+        get.assert_called_once()
+        self.assertFalse(self.s.sr_status_stale)
+        self.assertEqual(self.s.redis.scard(self.s.key_members_ids), 8)
+        self.assertEqual(self.s.redis.scard(self.s.key_rooms_previous), 3)
+
+    def test_flush_stats(self):
+        """ counters are rotated as read, with the ttl, the gauges are cleared """
+        class Stats(object):
+            @srphookimpl
+            def py_function_count(self, counter, counter_prev):
+                self.counter = counter
+
+            @srphookimpl
+            def change_count_room(self, count):
+                self.count = count
+        stats = Stats()
+        self.pm.register(stats)
+        self.s.function_counter("_test", 3)
+        self.s.redis.expire(self.s.key_func_count, 600)
+        self.s.function_gauge("_test", 1)
+        asyncio.run(srpusher_async.AsyncEngine(parent=self.s).flush_stats(count_room=2))
+        self.assertEqual((stats.counter["_test"], stats.count), ("3", 2))
+        self.assertEqual(self.s.redis.hget(self.s.key_func_count_previous, "_test"), "3")
+        self.assertGreater(self.s.redis.ttl(self.s.key_func_count_previous), 0)
+        self.assertFalse(self.s.redis.exists(self.s.key_func_gauge))
+
+
+class TestPresenceHistory(unittest.TestCase):
+    users = ["7939de86-6c83-49da-9ed1-08580d76bdf3", "4ee70da2-655f-4af9-a08e-c203dd37fea2"]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.s = SRPusher(configfilename="settings_test.yml", dry_run=True)
+        cls.s.redis.flushdb()
+        cls.p = PresenceHistory(parent=cls.s)
+
+    def test_intern(self):
+        """ same id for the same user, persistent in redis """
+        ids = self.s.intern.intern(self.users + self.users[:1])
+        self.assertEqual(ids[0], ids[2])
+        self.assertNotEqual(ids[0], ids[1])
+        s = SRPusher(configfilename="settings_test.yml", dry_run=True)
+        self.assertEqual(s.intern.lookup(self.users[1]), ids[1])
+        self.assertEqual(s.intern.userid(ids[0]), self.users[0])
+        self.assertIsNone(s.intern.lookup("unknown"))
+
+    def test_record_and_query(self):
+        day = datetime.date(2024, 1, 2)
+        t0 = datetime.datetime(2024, 1, 2, 10, 0, tzinfo=datetime.timezone.utc).timestamp()
+        # user0 online from 10:00, user1 joins at 10:03, both online until 10:05
+        self.p.record(self.users[:1], self.users[:1], now=t0)
+        self.p.record(self.users, self.users[1:], now=t0 + 180)
+        self.p.record(self.users, [], now=t0 + 300)
+        self.assertEqual(self.p.online_seconds(self.users[0], day, day), 6 * 60)
+        self.assertEqual(self.p.online_seconds(self.users[1], day, day), 3 * 60)
+        self.assertEqual(self.p.overlap_seconds(self.users[0], self.users[1], day, day), 3 * 60)
+        self.assertEqual(self.p.first_seen(self.users[1], day - datetime.timedelta(days=1), day), datetime.datetime(2024, 1, 2, 10, 3, tzinfo=datetime.timezone.utc))
+        self.assertEqual(self.p.last_seen(self.users[0], day, day + datetime.timedelta(days=1)), datetime.datetime(2024, 1, 2, 10, 5, tzinfo=datetime.timezone.utc))
+        self.assertIsNone(self.p.last_seen("unknown", day, day))
+
+
+class TestFetchPolicy(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.s = SRPusher(configfilename="settings_test.yml", dry_run=True)
+
+    def setUp(self):
+        self.s.redis.delete(FetchPolicy.key_policy)
+
+    def test_backoff_and_breaker(self):
+        policy = FetchPolicy(parent=self.s)
+        policy.backoff_base_sec, policy.breaker_failures, policy.breaker_cooldown_sec = 10, 3, 600
+        self.assertTrue(policy.allow(now=0))
+        policy.failure(now=0)
+        self.assertFalse(policy.allow(now=4.9))
+        self.assertTrue(policy.allow(now=10))
+        policy.failure(now=10)  # backoff 10..20 sec
+        self.assertGreaterEqual(policy.delay(now=10), 10)
+        self.assertLessEqual(policy.delay(now=10), 20)
+        policy.failure(now=30)
+        self.assertEqual(policy.state, "open")
+        self.assertFalse(policy.allow(now=629))
+        self.assertTrue(policy.allow(now=630))
+        self.assertEqual(policy.state, "half_open")
+        policy.failure(now=630)  # one error in half-open opens it again
+        self.assertEqual(policy.delay(now=630), 600)
+        self.assertTrue(policy.allow(now=1230))
+        policy.success()
+        self.assertEqual((policy.state, policy.failures, policy.delay()), ("closed", 0, 0))
+
+    def test_persistent(self):
+        """ another process (run once mode) honours the open breaker """
+        policy = FetchPolicy(parent=self.s)
+        policy.breaker_failures = 2
+        now = time.time()
+        policy.failure(now=now)
+        policy.failure(now=now)
+        self.assertEqual(policy.state, "open")
+        policy = FetchPolicy(parent=self.s)
+        self.assertFalse(policy.allow())
+        self.assertEqual(policy.state, "open")
+        self.assertGreater(policy.delay(), policy.breaker_cooldown_sec - 60)
+        self.assertTrue(policy.allow(now=now + policy.breaker_cooldown_sec))
+        self.assertEqual(self.s.redis.hget(FetchPolicy.key_policy, "state"), "half_open")
+        policy.success()
+        self.assertFalse(self.s.redis.exists(FetchPolicy.key_policy))
+
+    def test_stale(self):
+        """ an error keeps the previous status and marks it stale """
+        s = SRPusher(configfilename="settings_test.yml", dry_run=True)
+        self.assertIsNone(s.receive_sr_status(None, "timeout", 5))
+        self.assertTrue(s.sr_status_stale)
+        content = s.receive_sr_status(200, '{"rooms": []}', 1)
+        self.assertFalse(s.sr_status_stale)
+        s.fetch_policy.next_attempt = 0
+        self.assertIs(s.receive_sr_status(200, '<html>', 1), content)
+        self.assertTrue(s.sr_status_stale)
+        self.assertIs(s.receive_sr_status(503, '', 1), content)
+        self.assertEqual(s.fetch_policy.failures, 2)
+
+
+class TestDebouncer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.s = SRPusher(configfilename="settings_test.yml", dry_run=True)
+
+    def debouncer(self, cycles: int, seconds: float) -> Debouncer:
+        d = Debouncer(parent=self.s, kind="_test")
+        self.s.redis.delete(d.key)
+        d.cycles, d.seconds = cycles, seconds
+        return d
+
+    def test_disabled(self):
+        d = self.debouncer(1, 0)
+        self.assertEqual(d.filter(["u1"], ["u2"]), (["u1"], ["u2"]))
+
+    def test_cycles(self):
+        d = self.debouncer(2, 0)
+        self.assertEqual(d.filter(["u1"], ["u2"], now=0), ([], []))
+        self.assertEqual(d.filter([], [], now=1), (["u1"], ["u2"]))
+        # flapping: offline for a cycle, then back
+        self.assertEqual(d.filter([], ["u1"], now=2), ([], []))
+        self.assertEqual(d.filter(["u1"], [], now=3), ([], []))
+        self.assertEqual(d.filter([], [], now=4), ([], []))
+
+    def test_seconds_persistent(self):
+        """ pending transitions survive a restart (run once) """
+        d = self.debouncer(1, 60)
+        self.assertEqual(d.filter(["u1"], [], now=0), ([], []))
+        d = Debouncer(parent=self.s, kind="_test")
+        d.cycles, d.seconds = 1, 60
+        self.assertEqual(d.filter([], [], now=30), ([], []))
+        self.assertEqual(d.filter([], [], now=60), (["u1"], []))
+        self.assertEqual(d.first_seen, {"u1": 0})
+
+
+class TestEventStream(unittest.TestCase):
+    key = "_test_events"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.s = SRPusher(configfilename="settings_test.yml", dry_run=True)
+
+    def setUp(self):
+        self.s.redis.delete(self.key)
+
+    def test_publish_and_consume(self):
+        """ events are published at once, and shared among consumers of a group """
+        publisher = EventStreamPublisher(parent=self.s)
+        publisher.key = self.key
+        consumer1 = EventStreamConsumer(self.s.redis, group="g", consumer="c1", key=self.key)
+        consumer2 = EventStreamConsumer(self.s.redis, group="g", consumer="c2", key=self.key)
+        publisher.onlined_user(user={"userId": "U1", "nickname": "a"}, room={}, roomid="r1")
+        publisher.hit_keyword(messages=["keyword: x"], keyword=None)
+        self.assertEqual(self.s.redis.xlen(self.key), 0)
+        self.assertEqual(publisher.flush(), 2)
+        self.assertEqual(publisher.flush(), 0)
+
+        events = consumer1.read(count=1, block_ms=None)
+        self.assertEqual(events[0][1]["event"], "onlined_user")
+        self.assertEqual(events[0][1]["userid"], "u1")
+        self.assertEqual(events[0][1]["payload"]["nickname"], "a")
+        self.assertEqual(consumer1.ack([events[0][0]]), 1)
+        events = consumer2.read(count=10, block_ms=None)
+        self.assertEqual([e["event"] for _, e in events], ["hit_keyword"])
+        # consumer2 died without ack, consumer1 takes it over
+        self.assertEqual([e["event"] for _, e in consumer1.claim(min_idle_ms=0)], ["hit_keyword"])
+
+    def test_aborted_cycle(self):
+        """ events of an aborted cycle are not published by the next one """
+        pm = pluggy.PluginManager("srpusher")
+        s = SRPusher(configfilename="settings_test.yml", dry_run=True, pm=pm)
+        pm.add_hookspecs(SRPusher)
+        s.stream = EventStreamPublisher(parent=s)
+        s.stream.key = self.key
+        pm.register(s.stream)
+        s.stream.onlined_user(user={"userId": "_test_aborted"}, room={}, roomid="r1")
+        s.process_sr_status(copy.deepcopy(TestSRPusher()._sr_status))
+        self.assertNotIn("_test_aborted", [fields["userid"] for _, fields in self.s.redis.xrange(self.key)])
+
+
+class TestRoomAggregates(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.s = SRPusher(configfilename="settings_test.yml", dry_run=True)
+
+    def test_lifecycle(self):
+        """ running counters, finalized when the room has gone """
+        t0 = datetime.datetime(2024, 1, 2, 10, 0, tzinfo=datetime.timezone.utc).timestamp()
+        room = {"createTime": "2024-01-02 09:59:00 GMT", "members": [{"userId": "u1"}, {"userId": "u2"}]}
+        self.s.redis.delete("__roomstats___test", "__roomstats_hourly__2024010210", "__roomstats_daily__20240102")
+        stats = RoomAggregates(parent=self.s)
+        stats.update({"_test": room}, ["u1", "u2"], ["_test"], [], now=t0)
+        # run once mode: the next process continues from redis. U1 is logged in twice
+        stats = RoomAggregates(parent=self.s)
+        stats.update({"_test": dict(room, members=[{"userId": "u1"}, {"userId": "U1"}, {"userId": "u3"}, {"userId": "u4"}])}, ["u3", "u4"], [], [], now=t0 + 60)
+        live = stats.room_stats("_test")
+        self.assertEqual((live["lifetime_sec"], live["members_avg"], live["members_peak"]), (120, 3, 4))
+        stats.update({}, [], [], ["_test"], now=t0 + 120)
+        closed = stats.room_stats("_test")
+        self.assertEqual((closed["lifetime_sec"], closed["closed"]), (120, t0 + 120))
+        self.assertEqual(stats.daily_stats("20240102")["rooms_closed"], 1)
+        hourly = stats.hourly_stats("2024010210")
+        self.assertEqual((hourly["samples"], hourly["users_peak"], hourly["users_avg"], hourly["onlined_users"]), (3, 3, 5 / 3, 4))
+
+    def test_failover(self):
+        """ counts of another leader are added to, not overwritten. rooms gone unnoticed are forgotten """
+        t0 = datetime.datetime(2024, 1, 3, 10, 0, tzinfo=datetime.timezone.utc).timestamp()
+        room = {"createTime": "2024-01-03 09:59:00 GMT", "members": [{"userId": "u1"}]}
+        self.s.redis.delete("__roomstats___test2", "__roomstats_hourly__2024010310")
+        leader1 = RoomAggregates(parent=self.s)
+        leader1.update({"_test2": room}, [], [], [], now=t0)
+        leader2 = RoomAggregates(parent=self.s)
+        leader2.update({"_test2": room}, [], [], [], now=t0 + 60)
+        leader1.update({}, [], [], [], now=t0 + 120)
+        self.assertEqual(leader1.rooms, {})
+        self.assertEqual(leader1.hourly_stats("2024010310")["samples"], 3)
+        self.assertEqual(leader1.room_stats("_test2")["samples"], 2)
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.s = SRPusher(configfilename="settings_test.yml", dry_run=True)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.s.settings["archive"] = {"use": True, "path": os.path.join(self.tmpdir.name, "a.sqlite3"), "batch_size": 3, "flush_interval_sec": 3600}
+
+    def tearDown(self):
+        del self.s.settings["archive"]
+        self.tmpdir.cleanup()
+
+    def count(self) -> int:
+        with sqlite3.connect(self.s.settings["archive"]["path"]) as db:
+            return db.execute("SELECT count(*) FROM events").fetchone()[0]
+
+    def test_disabled(self):
+        self.assertIsNone(SRPusher_Archive(parent=None).db)
+        SRPusher_Archive(parent=None).onlined_user(user={}, room={}, roomid="r")
+
+    def test_batch(self):
+        """ events are written when the batch is full, and on close """
+        archive = SRPusher_Archive(parent=self.s)
+        user = {"userId": "7939DE86-6c83-49da-9ed1-08580d76bdf3", "nickname": "Ryan"}
+        archive.onlined_user(user=user, room={}, roomid="r1")
+        archive.hit_keyword(messages=["keyword: a", "keyword: b"], keyword=None)
+        self.assertEqual(self.count(), 3)
+        archive.offlined_user(user=user, room={}, roomid="r1")
+        self.assertEqual(self.count(), 3)
+        archive.close()
+        with sqlite3.connect(self.s.settings["archive"]["path"]) as db:
+            rows = db.execute("SELECT event, roomid, userid, name FROM events WHERE userid IS NOT NULL").fetchall()
+        self.assertEqual(rows, [("onlined_user", "r1", "7939de86-6c83-49da-9ed1-08580d76bdf3", "Ryan"), ("offlined_user", "r1", "7939de86-6c83-49da-9ed1-08580d76bdf3", "Ryan")])
+
+    def test_write_error(self):
+        """ events are kept for the next flush if the database can not be written """
+        archive = SRPusher_Archive(parent=self.s)
+        archive.db.execute("ALTER TABLE events RENAME TO events_")
+        archive.onlined_user(user={"userId": "u1"}, room={}, roomid="r1")
+        with self.assertRaises(sqlite3.Error):
+            archive.flush()
+        self.assertEqual(len(archive.buffer), 1)
+        # a full batch is not retried on every event until the interval has passed
+        with unittest.mock.patch("logging.error") as error:
+            archive.hit_keyword(messages=["keyword: a", "keyword: b", "keyword: c"], keyword=None)
+        error.assert_not_called()
+        self.assertEqual(len(archive.buffer), 4)
+        archive.db.execute("ALTER TABLE events_ RENAME TO events")
+        self.assertEqual(archive.flush(), 4)
+        archive.close()
+        self.assertEqual(self.count(), 4)
+
+
+class TestLeaderLease(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.s = SRPusher(configfilename="settings_test.yml", dry_run=True)
+        cls.s.redis.delete(LeaderLease.key_lease, LeaderLease.key_fence)
+
+    def tearDown(self):
+        self.s.lease = None
+        self.s.redis.delete(LeaderLease.key_lease)
+
+    def test_election(self):
+        """ only one leader, a standby takes over after release """
+        leader = LeaderLease(parent=self.s, owner="node1")
+        standby = LeaderLease(parent=self.s, owner="node2")
+        self.assertTrue(leader.acquire(60))
+        self.assertFalse(standby.acquire(60))
+        self.assertTrue(leader.acquire(60))  # renew
+        token = leader.token
+        leader.release()
+        self.assertFalse(leader.is_leader)
+        self.assertTrue(standby.acquire(60))
+        self.assertGreater(standby.token, token)
+
+    def test_fenced_write(self):
+        """ a stale leader can not commit state """
+        key = "_test_fenced"
+        leader = LeaderLease(parent=self.s, owner="node1")
+        self.assertTrue(leader.acquire(60))
+        self.s.lease = leader
+        self.s.fenced_write(lambda pipe: pipe.set(key, 1))
+        self.assertEqual(self.s.redis.get(key), "1")
+
+        # lease expired and taken over by another instance
+        self.s.redis.delete(LeaderLease.key_lease)
+        self.assertTrue(LeaderLease(parent=self.s, owner="node2").acquire(60))
+        with self.assertRaises(LeaseLostError):
+            self.s.fenced_write(lambda pipe: pipe.set(key, 2))
+        self.assertEqual(self.s.redis.get(key), "1")
+
+    def test_fenced_state(self):
+        """ debouncing state of a stale leader is not written either """
+        leader = LeaderLease(parent=self.s, owner="node1")
+        self.assertTrue(leader.acquire(60))
+        self.s.lease = leader
+        d = Debouncer(parent=self.s, kind="_test_fenced")
+        d.pending = {"user1": (1, 1, 0.0)}
+        self.s.redis.delete(LeaderLease.key_lease)
+        self.assertTrue(LeaderLease(parent=self.s, owner="node2").acquire(60))
+        with self.assertRaises(LeaseLostError):
+            d.save()
+        self.assertFalse(self.s.redis.exists(d.key))
+
+    def test_fenced_cycle(self):
+        """ a cycle aborted midway commits none of its state, the new leader emits its transitions """
+        def instance(owner):
+            pm = pluggy.PluginManager("srpusher")
+            s = SRPusher(configfilename="settings_test.yml", dry_run=True, pm=pm)
+            pm.add_hookspecs(SRPusher)
+            s.lease = LeaderLease(parent=s, owner=owner)
+            return s
+        leader = instance("node1")
+        leader.redis.delete(leader.key_members_ids, leader.key_members, leader.key_members_previous, leader.key_rooms_previous)
+        self.assertTrue(leader.lease.acquire(60))
+        filter_users = leader.debounce_users.filter
+
+        def taken_over(*args, **kwargs):
+            leader.redis.delete(LeaderLease.key_lease)
+            self.assertTrue(standby.lease.acquire(60))
+            return filter_users(*args, **kwargs)
+        leader.debounce_users.filter = taken_over
+        standby = instance("node2")
+        with self.assertRaises(LeaseLostError):
+            leader.process_sr_status(copy.deepcopy(TestSRPusher()._sr_status))
+        self.assertFalse(leader.redis.exists(leader.key_members_ids))
+        self.assertFalse(leader.redis.exists(leader.key_rooms_previous))
+
+        onlined_users, _, onlined_rooms = standby.check_sr_status_diff(copy.deepcopy(TestSRPusher()._sr_status))[:3]
+        self.assertEqual((len(onlined_users), len(onlined_rooms)), (8, 3))
+
+    def test_sleep_renews(self):
+        """ the lease is renewed while the leader waits longer than its ttl, and the wait ends when it is lost """
+        leader = LeaderLease(parent=self.s, owner="node1")
+        leader.ttl_sec = 0.3
+        self.assertTrue(leader.acquire())
+        self.s.lease = leader
+        self.s.sleep(0.5)
+        self.assertTrue(leader.acquire())
+
+        self.s.redis.delete(LeaderLease.key_lease)
+        self.assertTrue(LeaderLease(parent=self.s, owner="node2").acquire(60))
+        started = time.time()
+        self.s.sleep(5)
+        self.assertLess(time.time() - started, 1)
+        self.assertFalse(leader.is_leader)
+
+
+class TestLocalCache(unittest.TestCase):
+    def setUp(self):
+        self.s = SRPusher(configfilename="settings_test.yml", dry_run=True)
+        self.s.settings["cache"] = {"use": True, "max_entries": 2}
+        self.c = LocalCache(parent=self.s, prefixes=(self.s.header_usercache,))
+        self.c.client = self.s.redis  # without the listener, invalidate() is called by hand
+        self.c.enabled = True
+        self.keys = [self.s.header_usercache + f"_test{i}" for i in range(3)]
+        self.s.redis.delete(*self.keys)
+
+    def tearDown(self):
+        del self.s.settings["cache"]
+
+    def test_invalidate(self):
+        """ hits until another process modifies the key """
+        key = self.keys[0]
+        self.c.set(key, "a", ex=60)
+        self.assertEqual(self.s.redis.get(key), "a")
+        self.s.redis.set(key, "b")
+        self.assertEqual(self.c.get(key), "a")
+        self.c.invalidate([key])
+        self.assertEqual(self.c.get(key), "b")
+        self.assertEqual(self.c.get(key), "b")
+        self.assertEqual((self.c.counter["cache.hit"], self.c.counter["cache.miss"]), (2, 1))
+        self.c.invalidate(None)  # flushed
+        self.assertEqual(len(self.c.entries), 0)
+
+    def test_lru(self):
+        self.c.set(self.keys[0], "0", ex=60)
+        self.c.set(self.keys[1], "1", ex=60)
+        self.c.get(self.keys[0])
+        self.c.set(self.keys[2], "2", ex=60)
+        self.assertEqual(list(self.c.entries), [self.keys[0], self.keys[2]])
+
+    def test_invalidated_while_reading(self):
+        """ a value read before an invalidation is not cached """
+        cache = self.c
+
+        class Client(object):
+            def get(self, key):
+                cache.invalidate([key])
+                return "stale"
+        self.c.client = Client()
+        self.assertEqual(self.c.get(self.keys[0]), "stale")
+        self.assertNotIn(self.keys[0], self.c.entries)
+
+    def test_read_error(self):
+        """ a failed read leaves no pending entry behind """
+        class Client(object):
+            def get(self, key):
+                raise redis.ConnectionError("lost")
+        self.c.client = Client()
+        with self.assertRaises(redis.ConnectionError):
+            self.c.get(self.keys[0])
+        self.assertEqual(len(self.c.entries), 0)
+
+
+class TestLag(unittest.TestCase):
+    def setUp(self):
+        self.s = SRPusher(configfilename="settings_test.yml", dry_run=True)
+        self.s.settings["lag"] = {"use": True, "window_hours": 2, "slo_sec": 60}
+        self.lag = LagTracker(parent=self.s)
+        for key in self.s.redis.keys(LagTracker.header_lag + "*") + [LagTracker.key_last_poll, self.s.key_func_gauge]:
+            self.s.redis.delete(key)
+
+    def tearDown(self):
+        del self.s.settings["lag"]
+
+    def test_sketch(self):
+        """ percentiles within the relative accuracy """
+        sketch = LagSketch(relative_accuracy=0.02)
+        for value in range(1, 1001):
+            sketch.add(value)
+        for q in (50, 90, 99):
+            self.assertAlmostEqual(sketch.percentile(q), q * 10, delta=q * 10 * 0.02 + 1)
+        self.assertIsNone(LagSketch().percentile(50))
+
+    def test_lag(self):
+        """ detection and delivery lags over two polls """
+        t0 = 1700000000.0
+        roomid = "room1"
+        target = self.s.settings["sr"]["targets"][0]
+        self.s.current_rooms = {roomid: {"createTime": time.strftime("%Y-%m-%d %H:%M:%S GMT", time.gmtime(t0 - 30))}}
+        self.lag.detected([], [], now=t0)
+        self.lag.report(now=t0)
+
+        self.lag.detected([roomid], [target], now=t0 + 120)
+        self.lag.notifying([roomid], [roomid])
+        gauges = self.lag.report(now=t0 + 120)
+        self.assertAlmostEqual(gauges["lag.detect_room.p50"], 150, delta=3)
+        self.assertAlmostEqual(gauges["lag.detect_user.p50"], 120, delta=3)
+        self.lag.delivered(roomid, now=t0 + 125)
+        gauges = self.lag.report(now=t0 + 125)
+        self.assertAlmostEqual(gauges["lag.deliver.p50"], 155, delta=4)
+        self.assertEqual(float(self.s.redis.hget(self.s.key_func_gauge, "lag.deliver.count")), 1)
+
+        # the lag of pinned users (120) is over the slo (60), the interval is shortened in proportion
+        self.assertAlmostEqual(self.lag.cap_wait_sec(120, 20), 60, delta=2)
+        self.assertEqual(self.lag.cap_wait_sec(120, 80), 80)
+
+    def test_debounced(self):
+        """ the time a target user has been held back by debouncing is a part of the lag """
+        t0 = 1700000000.0
+        target = self.s.settings["sr"]["targets"][0]
+        self.lag.last_poll = t0
+        self.s.current_rooms = {"room1": {"members": [{"userId": target}]}}
+        self.lag.detected([], [target], now=t0 + 240, first_seen={target: t0 + 120})
+        self.lag.notifying(["room1"], [])
+        gauges = self.lag.report(now=t0 + 240)
+        self.assertAlmostEqual(gauges["lag.detect_user.p50"], 360, delta=8)
+        # the notification is counted from the same origin
+        self.lag.delivered("room1", now=t0 + 245)
+        gauges = self.lag.report(now=t0 + 245)
+        self.assertAlmostEqual(gauges["lag.deliver.p50"], 365, delta=8)
+
+    def test_window(self):
+        """ past hours are read once, the current hour every report """
+        t0 = 1700000000.0 - 1700000000.0 % 3600 + 1800
+        def hour(t):
+            return time.strftime("%Y%m%d%H", time.gmtime(t))
+        self.s.redis.hset(self.lag.key("deliver", hour(t0 - 3600)), "300", 1)
+        self.assertEqual(self.lag.report(now=t0)["lag.deliver.count"], 1)
+        self.s.redis.hset(self.lag.key("deliver", hour(t0 - 3600)), "300", 5)  # not read again
+        self.s.redis.hset(self.lag.key("deliver", hour(t0)), "300", 1)
+        self.assertEqual(self.lag.report(now=t0 + 60)["lag.deliver.count"], 2)
+
+
+class TestLogging(unittest.TestCase):
+    def test_json_lines(self):
+        record = logging.LogRecord("srpusher", logging.INFO, __file__, 1, "room dup: %s", ("Ryan",), None)
+        entry = json.loads(JsonLinesFormatter().format(record))
+        self.assertEqual((entry["level"], entry["logger"], entry["message"]), ("INFO", "srpusher", "room dup: Ryan"))
+        self.assertNotIn("exc", entry)
+
+    def test_lazy_queue(self):
+        """ the message is rendered when logged, args mutated afterwards do not show up """
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(JsonLinesFormatter())
+        q = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(q, handler)
+        logger = logging.getLogger("_test_lazy_queue")
+        logger.propagate = False
+        logger.addHandler(LazyQueueHandler(q))
+        user = {"a": 1}
+        logger.warning("(userstatus) %s", user)
+        user["a"] = 2
+        try:
+            raise ValueError("x")
+        except ValueError:
+            logger.exception("failed")
+        listener.start()
+        listener.stop()
+        entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(entries[0]["message"], "(userstatus) {'a': 1}")
+        self.assertIn("ValueError: x", entries[1]["exc"])
+
+    def test_lazy_queue_rich(self):
+        """ a handler rendering tracebacks by itself (rich_tracebacks) gets the exception """
+        q = queue.SimpleQueue()
+        try:
+            raise ValueError("x")
+        except ValueError:
+            record = logging.LogRecord("srpusher", logging.ERROR, __file__, 1, "failed %s", ("a",), sys.exc_info())
+        record = LazyQueueHandler(q, keep_exc_info=True).prepare(record)
+        self.assertEqual((record.getMessage(), record.exc_info[0]), ("failed a", ValueError))
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file